@@ -0,0 +1,234 @@
+import array
+import gzip
+import numpy as np
+
+FORMAT_LEGACY = 'legacy'
+FORMAT_BED12 = 'bed12'
+FORMAT_GTF = 'gtf'
+
+class Annotation:
+    #@profile
+    def __init__(self, annotationFile):
+        # Genes as a columnar table: exons of gene g are the rows
+        # geneOffsets[g]:geneOffsets[g+1] of exonStarts/exonEnds (0-based,
+        # end exclusive), ordered 5' to 3' along the transcript, so minus
+        # strand genes run from high to low coordinates. Annotated junctions
+        # (consecutive exons of a transcript) are kept the same way in
+        # junctionOffsets/junctionFirst/junctionSecond as exon indices
+        # within the gene.
+        self.annotationFile = annotationFile
+        self.geneNames = []
+        self.geneChroms = []
+        geneStrands = array.array('b')
+        exonGenes = array.array('q')
+        exonStarts = array.array('q')
+        exonEnds = array.array('q')
+        exonTranscripts = array.array('q')
+        self.format = self.detectFormat()
+        if self.format == FORMAT_GTF:
+            self.readGtf(geneStrands, exonGenes, exonStarts, exonEnds, exonTranscripts)
+        else:
+            self.readBed(geneStrands, exonGenes, exonStarts, exonEnds)
+
+        self.NG = len(self.geneNames)
+        self.geneStrands = np.array(geneStrands, dtype = np.int8)
+        exonGenes = np.array(exonGenes, dtype = np.int64)
+        self.exonStarts = np.array(exonStarts, dtype = np.int64)
+        self.exonEnds = np.array(exonEnds, dtype = np.int64)
+        if self.format == FORMAT_GTF:
+            # Exons shared by several transcripts of a gene are kept once;
+            # unique[i] is the kept exon of input exon i.
+            sign = self.geneStrands[exonGenes].astype(np.int64)
+            order = np.lexsort((sign * self.exonEnds, sign * self.exonStarts, exonGenes))
+            sortedGenes = exonGenes[order]
+            sortedStarts = self.exonStarts[order]
+            sortedEnds = self.exonEnds[order]
+            keep = np.ones(len(order), dtype = bool)
+            keep[1:] = ((sortedGenes[1:] != sortedGenes[:-1]) | (sortedStarts[1:] != sortedStarts[:-1])
+                        | (sortedEnds[1:] != sortedEnds[:-1]))
+            unique = np.empty(len(order), dtype = np.int64)
+            unique[order] = np.cumsum(keep) - 1
+            transcripts = np.array(exonTranscripts, dtype = np.int64)
+            exonGenes = sortedGenes[keep]
+            self.exonStarts = sortedStarts[keep]
+            self.exonEnds = sortedEnds[keep]
+        else:
+            # Every line is one transcript
+            unique = np.arange(len(exonGenes))
+            transcripts = exonGenes
+        self.geneOffsets = np.zeros(self.NG + 1, dtype = np.int64)
+        np.cumsum(np.bincount(exonGenes, minlength = self.NG), out = self.geneOffsets[1:])
+        self.NE = np.diff(self.geneOffsets).tolist()
+        self.geneRecords = None
+        self.readJunctions(unique, transcripts, exonGenes)
+    
+    #@profile
+    def readJunctions(self, unique, transcripts, exonGenes):
+        # Exons of a transcript in 5' to 3' order are consecutive kept
+        # exons sorted by index; each neighbouring pair is a junction.
+        order = np.lexsort((unique, transcripts))
+        exons = unique[order]
+        transcripts = transcripts[order]
+        pick = np.flatnonzero((transcripts[1:] == transcripts[:-1]) & (exons[1:] != exons[:-1]))
+        genes = exonGenes[exons[pick]]
+        first = exons[pick] - self.geneOffsets[genes]
+        second = exons[pick + 1] - self.geneOffsets[genes]
+        order = np.lexsort((second, first, genes))
+        genes = genes[order]
+        first = first[order]
+        second = second[order]
+        keep = np.ones(len(order), dtype = bool)
+        keep[1:] = (genes[1:] != genes[:-1]) | (first[1:] != first[:-1]) | (second[1:] != second[:-1])
+        genes = genes[keep]
+        self.junctionFirst = first[keep]
+        self.junctionSecond = second[keep]
+        self.junctionOffsets = np.zeros(self.NG + 1, dtype = np.int64)
+        np.cumsum(np.bincount(genes, minlength = self.NG), out = self.junctionOffsets[1:])
+        return
+
+    def open(self):
+        headIn = open(self.annotationFile, 'rb')
+        compressed = headIn.read(2) == b'\x1f\x8b'
+        headIn.close()
+        if compressed:
+            return gzip.open(self.annotationFile, 'rt')
+        return open(self.annotationFile, 'r')
+
+    #@profile
+    def detectFormat(self):
+        # .gtf by extension as in CPSIE; a .bed file is BED12 if its first
+        # record has 12 columns, otherwise the legacy 4-column layout
+        # (name, exon count, starts, inclusive ends in genome-wide offsets).
+        name = self.annotationFile.lower()
+        if name.endswith('.gz'):
+            name = name[:-3]
+        if name.endswith('.gtf'):
+            return FORMAT_GTF
+        fileIn = self.open()
+        for line in fileIn:
+            if len(line.strip()) > 0 and not line.startswith(('#', 'track', 'browser')):
+                fileIn.close()
+                return FORMAT_BED12 if len(line.rstrip('\r\n').split('\t')) >= 12 else FORMAT_LEGACY
+        fileIn.close()
+        return FORMAT_LEGACY
+
+    #@profile
+    def readBed(self, geneStrands, exonGenes, exonStarts, exonEnds):
+        # One line per gene, as in CPSIE's readFromBed
+        fileIn = self.open()
+        for line in fileIn:
+            if len(line.strip()) == 0 or line.startswith(('#', 'track', 'browser')):
+                continue
+            sub = line.rstrip('\r\n').split('\t')
+            g = len(self.geneNames)
+            if self.format == FORMAT_LEGACY:
+                COL_EXONNUM = 1
+                COL_EXONST = 2
+                COL_EXONED = 3
+                num = int(sub[COL_EXONNUM])
+                starts = [int(x) for x in sub[COL_EXONST].split(',')[:num]]
+                ends = [int(x) + 1 for x in sub[COL_EXONED].split(',')[:num]]
+                self.geneNames.append(sub[0])
+                self.geneChroms.append(None)
+                geneStrands.append(1)
+            else:
+                COL_CHROM = 0
+                COL_CHROMST = 1
+                COL_NAME = 3
+                COL_STRAND = 5
+                COL_EXONNUM = 9
+                COL_EXONLEN = 10
+                COL_EXONST = 11
+                num = int(sub[COL_EXONNUM])
+                chromSt = int(sub[COL_CHROMST])
+                starts = [chromSt + int(x) for x in sub[COL_EXONST].split(',')[:num]]
+                ends = [st + int(x) for st, x in zip(starts, sub[COL_EXONLEN].split(',')[:num])]
+                strand = -1 if sub[COL_STRAND] == '-' else 1
+                if strand < 0:
+                    starts.reverse()
+                    ends.reverse()
+                self.geneNames.append(sub[COL_NAME])
+                self.geneChroms.append(sub[COL_CHROM])
+                geneStrands.append(strand)
+            exonGenes.extend([g] * num)
+            exonStarts.extend(starts)
+            exonEnds.extend(ends)
+        fileIn.close()
+        return
+
+    #@profile
+    def readGtf(self, geneStrands, exonGenes, exonStarts, exonEnds, exonTranscripts):
+        # Only exon lines are split in full and only gene_id is looked up in
+        # the attributes; genes keep the chromosome and strand of their
+        # first exon.
+        COL_CHROM = 0
+        COL_FEATURE = 2
+        COL_START = 3
+        COL_END = 4
+        COL_STRAND = 6
+        COL_ATTR = 8
+        geneIdx = {}
+        transcriptIdx = {}
+        fileIn = self.open()
+        for line in fileIn:
+            if line.startswith('#'):
+                continue
+            sub = line.split('\t', COL_ATTR)
+            if len(sub) <= COL_ATTR or sub[COL_FEATURE] != 'exon':
+                continue
+            attr = sub[COL_ATTR]
+            pos = attr.find('gene_id "')
+            if pos < 0:
+                continue
+            geneId = attr[pos + 9:attr.find('"', pos + 9)]
+            g = geneIdx.get(geneId)
+            if g is None:
+                g = len(self.geneNames)
+                geneIdx[geneId] = g
+                self.geneNames.append(geneId)
+                self.geneChroms.append(sub[COL_CHROM])
+                geneStrands.append(-1 if sub[COL_STRAND] == '-' else 1)
+            pos = attr.find('transcript_id "')
+            transcriptId = attr[pos + 15:attr.find('"', pos + 15)] if pos >= 0 else geneId
+            t = transcriptIdx.get(transcriptId)
+            if t is None:
+                t = len(transcriptIdx)
+                transcriptIdx[transcriptId] = t
+            exonGenes.append(g)
+            exonStarts.append(int(sub[COL_START]) - 1)
+            exonEnds.append(int(sub[COL_END]))
+            exonTranscripts.append(t)
+        fileIn.close()
+        return
+
+    #@profile
+    def resolve(self, genome):
+        # Genome record of every gene; 'chr1' and '1' are taken as the same
+        # name. Legacy genes use genome-wide offsets and get -1.
+        self.geneRecords = np.full(self.NG, -1, dtype = np.int64)
+        for g in range(self.NG):
+            chrom = self.geneChroms[g]
+            if chrom is None:
+                continue
+            for name in [chrom, chrom[3:] if chrom.startswith('chr') else 'chr' + chrom]:
+                if name in genome.nameIdx:
+                    self.geneRecords[g] = genome.nameIdx[name]
+                    break
+            else:
+                raise ValueError('Unknown chromosome ' + chrom + ' of gene ' + self.geneNames[g])
+        return
+
+    def exons(self, g):
+        st = self.geneOffsets[g]
+        ed = self.geneOffsets[g + 1]
+        return list(zip(self.exonStarts[st:ed].tolist(), self.exonEnds[st:ed].tolist()))
+
+    def junctions(self, g):
+        st = self.junctionOffsets[g]
+        ed = self.junctionOffsets[g + 1]
+        return list(zip(self.junctionFirst[st:ed].tolist(), self.junctionSecond[st:ed].tolist()))
+
+    def exonLengths(self, g):
+        st = self.geneOffsets[g]
+        ed = self.geneOffsets[g + 1]
+        return (self.exonEnds[st:ed] - self.exonStarts[st:ed]).tolist()
\ No newline at end of file
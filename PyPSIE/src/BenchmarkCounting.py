@@ -0,0 +1,31 @@
+from KmerHash import KmerHash
+import numpy as np
+import time
+
+#@profile
+def work():
+    exonBoundaryFile = r'../input/exonBoundary.bed'
+    genomeFile = r'../input/genome.fa'
+    readsFile = r'../input/reads.fq'
+    K = 15
+    readLength = 75
+    kmerHasher = KmerHash(K, readLength, genomeFile, exonBoundaryFile, readsFile)
+
+    print('\n======Counting Benchmark==============')
+    timeSt = time.time()
+    serialCodes, serialCounts, serialLengths = kmerHasher.countReads(readsFile)
+    serialTime = time.time() - timeSt
+    print('Serial: ' + str(serialTime) + 's, ' + str(len(serialCodes)) + ' kmers')
+
+    for batchSize in [1000, 10000, 100000]:
+        timeSt = time.time()
+        batchCodes, batchCounts, batchLengths = kmerHasher.countReadsBatch(readsFile, batchSize)
+        batchTime = time.time() - timeSt
+        identical = (np.array_equal(batchCodes, serialCodes) and np.array_equal(batchCounts, serialCounts)
+                     and np.array_equal(batchLengths, serialLengths))
+        print('Batch ' + str(batchSize) + ': ' + str(batchTime) + 's, '
+              + str(len(batchCodes)) + ' kmers, speedup '
+              + '{0:.2f}'.format(serialTime / batchTime)
+              + ', identical: ' + str(identical))
+
+work()
@@ -0,0 +1,58 @@
+from KmerHash import KmerHash
+from EMAlgorithm import EMAlgorithm
+from ReadParser import ReadParser
+from BenchmarkPrefilter import addErrors, checkPsi
+import random
+import time
+
+# Read lengths after 3' trimming; None leaves the read whole
+TRIM_LENGTHS = [None, None, None, 60, 50, 40, 30, 20, 12, 0]
+PSI_TOL = 1e-6
+
+#@profile
+def trimReads(readsFile, trimFile):
+    # Variable-length reads as adapter trimmers leave them, down to empty
+    # ones, with a fixed seed.
+    random.seed(3)
+    fileOut = open(trimFile, 'w')
+    for read in ReadParser(readsFile).reads():
+        length = random.choice(TRIM_LENGTHS)
+        fileOut.write(read[:length].decode('ascii') + '\n')
+    fileOut.close()
+    return
+
+#@profile
+def work():
+    exonBoundaryFile = r'../input/exonBoundary.bed'
+    genomeFile = r'../input/genome.fa'
+    readsFile = r'../input/reads.fq'
+    errorFile = r'../output/readsError.fq'
+    trimFile = r'../output/readsTrimmed.fq'
+    K = 15
+    readLength = 75
+    batchSize = 10000
+    groundTruthFile = r'../kits/PsiGroundTruth.json'
+    psiFile = r'../output/PsiResult.json'
+    addErrors(readsFile, 0.01, errorFile)
+    trimReads(readsFile, trimFile)
+
+    print('\n======M-step Engine Benchmark=========')
+    results = []
+    for inputName, inputFile in [('clean', readsFile), ('1% substitutions', errorFile), ('trimmed', trimFile)]:
+        kmerHasher = KmerHash(K, readLength, genomeFile, exonBoundaryFile, inputFile, batchSize = batchSize)
+        for engine, schedule in [('slsqp', False), ('slsqp', True), ('multiplicative', False), ('multiplicative', True)]:
+            timeSt = time.time()
+            solver = EMAlgorithm(kmerHasher)
+            solver.work(10, engine, schedule)
+            totalTime = time.time() - timeSt
+            outOfRange = sum([1 for psi in solver.Psi for val in psi if val < -PSI_TOL or val > 1 + PSI_TOL])
+            results.append((inputName, engine, schedule, totalTime, outOfRange, checkPsi(groundTruthFile, psiFile)))
+
+    print('\n======M-step Engine Results===========')
+    for inputName, engine, schedule, totalTime, outOfRange, check in results:
+        print('Reads ' + inputName + ', engine ' + engine + (' (scheduled)' if schedule else '') + ': '
+              + '{0:.2f}'.format(totalTime) + 's, ' + str(outOfRange) + ' Psi outside [0, 1]')
+        for line in check:
+            print('    ' + line)
+
+work()
@@ -0,0 +1,71 @@
+from KmerHash import KmerHash
+from EMAlgorithm import EMAlgorithm
+from ReadParser import ReadParser
+import subprocess
+import random
+import time
+import sys
+
+CHECK_PSI = r'../../CPSIE/src/checkPsi.py'
+
+#@profile
+def addErrors(readsFile, errorRate, errorFile):
+    # Substitutions at errorRate per base with a fixed seed, written one
+    # read per line; without errors the prefilter has nothing to drop.
+    random.seed(7)
+    fileOut = open(errorFile, 'w')
+    for read in ReadParser(readsFile).reads():
+        bases = list(read.decode('ascii'))
+        for i in range(len(bases)):
+            if random.random() < errorRate:
+                bases[i] = random.choice('ACGT')
+        fileOut.write(''.join(bases) + '\n')
+    fileOut.close()
+    return
+
+#@profile
+def checkPsi(groundTruthFile, psiFile):
+    # CPSIE's checker on the Psi that EMAlgorithm.computePSI wrote
+    checker = subprocess.run([sys.executable, CHECK_PSI, groundTruthFile, psiFile],
+                             stdout = subprocess.PIPE, universal_newlines = True, check = True)
+    return checker.stdout.splitlines()
+
+#@profile
+def work():
+    # BenchmarkPrefilter.py [readsFile [errorRate]]
+    exonBoundaryFile = r'../input/exonBoundary.bed'
+    genomeFile = r'../input/genome.fa'
+    readsFile = sys.argv[1] if len(sys.argv) > 1 else r'../input/reads.fq'
+    errorRate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+    if errorRate > 0:
+        errorFile = r'../output/readsError.fq'
+        addErrors(readsFile, errorRate, errorFile)
+        readsFile = errorFile
+    K = 15
+    readLength = 75
+    batchSize = 10000
+    groundTruthFile = r'../kits/PsiGroundTruth.json'
+    psiFile = r'../output/PsiResult.json'
+
+    print('\n======Prefilter Benchmark=============')
+    results = []
+    for prefilter in [0, 1 << 18, 1 << 22, 1 << 26]:
+        timeSt = time.time()
+        kmerHasher = KmerHash(K, readLength, genomeFile, exonBoundaryFile, readsFile, batchSize = batchSize, prefilter = prefilter)
+        hashTime = time.time() - timeSt
+        solver = EMAlgorithm(kmerHasher)
+        solver.work(10)
+        totalTime = time.time() - timeSt
+        results.append((prefilter, kmerHasher.NW, hashTime, totalTime, checkPsi(groundTruthFile, psiFile)))
+
+    print('\n======Prefilter Results===============')
+    print('Reads ' + readsFile + ', substitution rate ' + str(errorRate))
+    for prefilter, NW, hashTime, totalTime, check in results:
+        print('Prefilter ' + '{0:.2f}'.format(prefilter / float(1 << 20)) + ' MB: '
+              + str(NW) + ' kmers, hashing ' + '{0:.2f}'.format(hashTime) + 's, total '
+              + '{0:.2f}'.format(totalTime) + 's')
+        for line in check:
+            print('    ' + line)
+
+if __name__ == '__main__':
+    work()
@@ -0,0 +1,61 @@
+import numpy as np
+
+MIX_A = np.uint64(0xBF58476D1CE4E5B9)
+MIX_B = np.uint64(0x94D049BB133111EB)
+SEED = np.uint64(0x9E3779B97F4A7C15)
+POPCOUNT = np.array([bin(x).count('1') for x in range(256)], dtype = np.uint8)
+
+def mixHash(x):
+    # splitmix64 finalizer, wrapping uint64 arithmetic
+    x = x ^ (x >> np.uint64(30))
+    x = x * MIX_A
+    x = x ^ (x >> np.uint64(27))
+    x = x * MIX_B
+    return x ^ (x >> np.uint64(31))
+
+class BloomFilter:
+    #@profile
+    def __init__(self, nBytes, hashes):
+        self.bits = np.zeros(nBytes, dtype = np.uint8)
+        self.size = np.uint64(8 * nBytes)
+        self.hashes = hashes
+        self.inserted = 0
+
+    #@profile
+    def positions(self, codes):
+        # Double hashing: bit i of a code is h1 + i*h2 modulo the size
+        x = np.asarray(codes).astype(np.uint64)
+        h1 = mixHash(x)
+        h2 = mixHash(x ^ SEED) | np.uint64(1)
+        return [(h1 + np.uint64(i) * h2) % self.size for i in range(self.hashes)]
+
+    #@profile
+    def contains(self, codes):
+        found = np.ones(len(codes), dtype = bool)
+        for pos in self.positions(codes):
+            found &= (self.bits[pos >> np.uint64(3)] >> (pos & np.uint64(7)).astype(np.uint8)) & 1 > 0
+        return found
+
+    #@profile
+    def add(self, codes):
+        # Bits falling into the same byte are OR-ed together first, since a
+        # fancy-indexed |= keeps only one write per byte.
+        if len(codes) == 0:
+            return
+        pos = np.unique(np.concatenate(self.positions(codes)))
+        byte = pos >> np.uint64(3)
+        masks = np.left_shift(1, (pos & np.uint64(7)).astype(np.uint8)).astype(np.uint8)
+        head = np.ones(len(byte), dtype = bool)
+        head[1:] = byte[1:] != byte[:-1]
+        start = np.flatnonzero(head)
+        self.bits[byte[start]] |= np.bitwise_or.reduceat(masks, start)
+        self.inserted += len(codes)
+        return
+
+    #@profile
+    def falsePositiveRate(self):
+        # Measured from the share of set bits, and the textbook estimate
+        # from the number of inserted codes
+        fill = POPCOUNT[self.bits].sum() / float(self.size)
+        expected = (1 - np.exp(-self.hashes * self.inserted / float(self.size))) ** self.hashes
+        return fill ** self.hashes, expected
\ No newline at end of file
@@ -3,44 +3,56 @@ import scipy.sparse as spa
 import numpy as np
 import json
 import time
+import multiprocessing
+
+ENGINE_SLSQP = 'slsqp'
+ENGINE_MULTIPLICATIVE = 'multiplicative'
+MULTIPLICATIVE_TOL = 1e-10
+CONSTRAINT_TOL = 1e-9
+TOL_START = 1e-10
+TOL_SCALE = 1e-11
+SKIP_TOL = 1e-6
+
+workerSolver = None
+
+def initialWorker(solver):
+    global workerSolver
+    workerSolver = solver
+
+def optimizeGene(task):
+    # Workers keep TauLocal and A from the fork; a task only carries the
+    # gene's coef and current X.
+    g, coef, X, t, tolerance = task
+    timeSt = time.clock()
+    workerSolver.coef[g] = coef
+    res = workerSolver.solveQ(g, X.copy(), t, tolerance)
+    return g, res.x, res.fun, res.message, time.clock() - timeSt
 
 class EMAlgorithm:
     #@profile
-    def __init__(self, kmerHasher):
+    def __init__(self, kmerHasher, workers = 1):
         self.EPS = 1e-30
+        self.workers = workers
+        self.pool = None
+        self.engine = ENGINE_SLSQP
+        self.schedule = False
+        self.tolerance = self.EPS
         self.NG = kmerHasher.NG
         self.NE = kmerHasher.NE
         self.K = kmerHasher.K
         self.NW = kmerHasher.NW
         self.readLength = kmerHasher.readLength
         
-        self.initialIndice()
+        self.initialIndice(kmerHasher)
         self.initialCoefficients(kmerHasher)
         self.initialConstraints()
         
     #@profile
-    def initialIndice(self):
-        self.NX = []
-        for g in range(self.NG):
-            self.NX.append(int(self.NE[g] * (self.NE[g] + 1) / 2))
-            
-        self.NXSUM = [0]
-        for g in range(self.NG):
-            self.NXSUM.append(self.NX[g] + self.NXSUM[g])
-            
-        self.MergeIdx = {}
-        self.SplitIdx = []
-        idx = 0
-        for g in range(self.NG):
-            for e in range(self.NE[g]):
-                self.SplitIdx.append((g,e,e))
-                self.MergeIdx[(g,e,e)] = idx
-                idx += 1
-            for ei in range(self.NE[g]):
-                for ej in range(ei + 1, self.NE[g]):
-                    self.SplitIdx.append((g,ei,ej))
-                    self.MergeIdx[(g,ei,ej)] = idx
-                    idx += 1        
+    def initialIndice(self, kmerHasher):
+        self.NX = kmerHasher.NX
+        self.NXSUM = kmerHasher.NXSUM
+        self.MergeIdx = kmerHasher.MergeIdx
+        self.SplitIdx = kmerHasher.SplitIdx
 
     #@profile
     def initialCoefficients(self, kmerHasher):
@@ -49,106 +61,94 @@ class EMAlgorithm:
             self.L.append(np.zeros((1, self.NX[g])))
         for g in range(self.NG):
             col = 0
+            exonLengths = kmerHasher.annotation.exonLengths(g)
             for e in range(self.NE[g]):
-                st = kmerHasher.geneBoundary[g][e][0]
-                ed = kmerHasher.geneBoundary[g][e][1] + 1
-                self.L[g][0, col] = ed - st - self.readLength + 1
+                self.L[g][0, col] = kmerHasher.exonLength(exonLengths[e])
+                if self.L[g][0, col] <= 0:
+                    # No read starts in the exon, so its X column would be
+                    # divided by zero in A
+                    raise ValueError('Exon ' + str(e) + ' of gene ' + kmerHasher.annotation.geneNames[g] + ' is '
+                                     + str(exonLengths[e]) + ' bp, shorter than the shortest read ('
+                                     + str(min(kmerHasher.readLengths)) + ' bp); merge or drop it in the annotation')
+                col += 1
+            while col < self.NX[g]:
+                self.L[g][0, col] = kmerHasher.junctionLength()
                 col += 1
-            for ei in range(self.NE[g]):
-                ej = ei + 1
-                while ej < self.NE[g]:
-                    self.L[g][0, col] = 2 * self.readLength - 2 - self.readLength + 1
-                    ej += 1
-                    col += 1
         
         for x in self.L:
             print(x)
 
-        #self.Tau = spa.lil_matrix((self.NW, self.NXSUM[self.NG]))
-        self.Tau = []
-        for g in range(self.NG):
-            self.Tau.append(spa.lil_matrix((self.NW, self.NX[g])))
-            
+        # One NW x sum(NX) CSR matrix, gene g owning the columns
+        # NXSUM[g]:NXSUM[g+1]
+        self.Tau = spa.csr_matrix(kmerHasher.Tau)
+        self.Tau.sort_indices()
             
-        self.W = np.zeros((1, self.NW))
-        self.MuNonZero = []
-        row = 0
-        for kmer in kmerHasher.kmerTable:
-            self.W[0, row] = kmerHasher.kmerTable[kmer][0]
-            contribution = kmerHasher.kmerTable[kmer][1]
-            
-            gSet = {}
-            for loc in contribution:
-                sub = loc.split(',')
-                g = int(sub[0])
-                ei = int(sub[1])
-                ej = int(sub[2])
-                col = self.MergeIdx[(g, ei, ej)]
-                
-                #self.Tau[row, col] = contribution[loc]
-                col = col - self.NXSUM[g]
-                self.Tau[g][row, col] = contribution[loc]
-                
-                gSet[g] = True
-                
-            for g in gSet:
-                self.MuNonZero.append((row, g))
-            row += 1
+        self.W = kmerHasher.W.reshape((1, self.NW))
+        
+        # Within a row the entries of one gene are contiguous, so every
+        # (row, gene) pair is a segment of the CSR data; Mu holds one value
+        # per segment, segment i being (MuRow[i], MuGene[i]).
+        self.colGene = np.repeat(np.arange(self.NG), self.NX)
+        rows = np.repeat(np.arange(self.NW), np.diff(self.Tau.indptr))
+        entryGene = self.colGene[self.Tau.indices]
+        head = np.ones(len(rows), dtype = bool)
+        head[1:] = (rows[1:] != rows[:-1]) | (entryGene[1:] != entryGene[:-1])
+        self.segStart = np.flatnonzero(head)
+        self.MuRow = rows[self.segStart]
+        self.MuGene = entryGene[self.segStart]
+        order = np.argsort(self.MuGene, kind = 'mergesort')
+        segOffsets = np.zeros(self.NG + 1, dtype = np.int64)
+        np.cumsum(np.bincount(self.MuGene, minlength = self.NG), out = segOffsets[1:])
+        self.geneSegs = np.split(order, segOffsets[1:-1])
+        
+        # The M-step of gene g only sees the k-mers it can produce: local
+        # row i of TauLocal[g] is global row geneRows[g][i], which gathers W
+        # and the E-step values for it.
+        segLocal = np.empty(len(order), dtype = np.int64)
+        segLocal[order] = np.arange(len(order)) - segOffsets[self.MuGene[order]]
+        localRows = segLocal[np.cumsum(head) - 1]
+        localCols = self.Tau.indices - np.asarray(self.NXSUM)[entryGene]
+        entryOrder = np.argsort(entryGene, kind = 'mergesort')
+        entryOffsets = np.zeros(self.NG + 1, dtype = np.int64)
+        np.cumsum(np.bincount(entryGene, minlength = self.NG), out = entryOffsets[1:])
+        self.geneRows = []
+        self.TauLocal = []
+        for g in range(self.NG):
+            pick = entryOrder[entryOffsets[g]:entryOffsets[g+1]]
+            self.geneRows.append(self.MuRow[self.geneSegs[g]])
+            self.TauLocal.append(spa.csr_matrix((self.Tau.data[pick], (localRows[pick], localCols[pick])),
+                                                shape = (len(self.geneSegs[g]), self.NX[g])))
         #print(len(self.Tau[0].nonzero()[0]))
             
     #@profile
     def initialConstraints(self):
+        # Rows 0..NE-2: exon e covers the junctions leaving it; rows
+        # NE-1..2NE-3: exon e covers the junctions entering it; rows
+        # 2NE-2..3NE-5: for every inner exon e, the other exons cover all
+        # junctions. Junction columns come from SplitIdx, so any subset of
+        # exon pairs works; with all pairs this is the original matrix.
         self.NA = []
-        for g in range(self.NG):
-            if self.NE[g] > 2:
-                self.NA.append(3 * self.NE[g] - 4)
-            else:
-                self.NA.append(self.NE[g])
-            
         self.A = []
         for g in range(self.NG):
-            self.A.append(np.zeros((self.NA[g], self.NX[g])))
-        for g in range(self.NG):
-            if self.NA[g] == 1:
-                self.A[g][0, 0] = 1
-                break
-            
-            row = 0
-            
-            NRightJunc = self.NE[g] - 1
-            l = self.NE[g]
-            r = l + self.NE[g] - 1
-            while row < NRightJunc:
-                self.A[g][row, row] = 1
-                for i in range(l, r):
-                    self.A[g][row, i] = -1
-                l = r
-                r = r + self.NE[g] - (row + 2)
-                row += 1
-            
-            NLeftJunc = NRightJunc + self.NE[g] - 1
-            while row < NLeftJunc:
-                self.A[g][row, row - NRightJunc + 1] = 1
-                l = self.NE[g]
-                r = row - NRightJunc
-                i = 1
-                while r >= 0:
-                    self.A[g][row, l + r] = -1
-                    l += self.NE[g] - i
-                    i += 1
-                    r -= 1     
-                row += 1                
-            
-            NPsi = NLeftJunc + self.NE[g] - 2
-            while row < NPsi:
-                for i in range(self.NX[g]):
-                    if i >= self.NE[g]:
-                        self.A[g][row, i] = -1 
-                    elif i != row - NLeftJunc + 1:
-                        self.A[g][row, i] = 1
-                row += 1                
-                
-            self.A[g] = self.A[g] / (np.ones((self.NA[g], 1)).dot(self.L[g]))
+            NE = self.NE[g]
+            if NE == 1:
+                A = np.ones((1, self.NX[g]))
+            else:
+                A = np.zeros((3 * NE - 4, self.NX[g]))
+                for e in range(NE - 1):
+                    A[e, e] = 1
+                for e in range(1, NE):
+                    A[NE - 2 + e, e] = 1
+                for e in range(1, NE - 1):
+                    A[2 * NE - 3 + e, :NE] = 1
+                    A[2 * NE - 3 + e, e] = 0
+                for x in range(NE, self.NX[g]):
+                    gene, ei, ej = self.SplitIdx[self.NXSUM[g] + x]
+                    A[ei, x] = -1
+                    A[NE - 2 + ej, x] = -1
+                    A[2 * NE - 2:, x] = -1
+            self.NA.append(A.shape[0])
+            self.A.append(A / (np.ones((self.NA[g], 1)).dot(self.L[g])))
     
     #@profile
     def initialX(self, g):
@@ -184,6 +184,7 @@ class EMAlgorithm:
         self.X = []
         for g in range(self.NG):
             self.X.append(self.initialX(g))
+        self.xChange = np.full(self.NG, np.inf)
 
         #self.Mu = spa.lil_matrix((self.NW, self.NG))
         return
@@ -206,31 +207,61 @@ class EMAlgorithm:
         #     g = loca[1]
         #     self.Mu[s, g] /= tot[s]
         #=======================================================================
-        self.Mu = []
-        tot = np.zeros((self.NW, 1))
-        for g in range(self.NG):
-            self.Mu.append(np.multiply(self.Tau[g].dot(self.X[g].T), self.Z[0, g]))
-            tot += self.Mu[g]        
-        for g in range(self.NG):
-            self.Mu[g] = spa.lil_matrix(np.divide(self.Mu[g], tot))            
+        # Z[g] * Tau[s, x] * X[x] for every stored entry, summed per
+        # (row, gene) segment and normalized by the row total. k-mers no
+        # gene can produce (sequencing errors) have no segment, rows summing
+        # to 0 get no responsibility.
+        X = np.concatenate([np.asarray(self.X[g]).ravel() for g in range(self.NG)])
+        X *= self.Z[0, self.colGene]
+        mu = np.add.reduceat(self.Tau.data * X[self.Tau.indices], self.segStart) if len(self.segStart) > 0 else np.zeros(0)
+        tot = np.bincount(self.MuRow, weights = mu, minlength = self.NW)[self.MuRow]
+        self.Mu = np.divide(mu, tot, out = np.zeros_like(mu), where = tot > 0)
             
-        print('look at me!!!' + str(self.Mu[0].sum()))
+        print('look at me!!!' + str(self.Mu[self.geneSegs[0]].sum()))
         print(self.W.sum())
         print(self.Z)
         return
      
     #@profile
     def mStep(self, t):
-        tot = 0.0
-        for g in range(self.NG):
-            self.Z[0, g] = self.Mu[g].T.dot(self.W.T)
-            tot += self.Z[0, g]
-        for g in range(self.NG):
-            self.Z[0, g] /= tot
+        prevZ = self.Z.copy()
+        self.Z[0] = np.bincount(self.MuGene, weights = self.Mu * self.W[0, self.MuRow], minlength = self.NG)
+        self.Z /= self.Z.sum()
+        
+        # With the schedule on, a gene whose X and Z both moved less than
+        # SKIP_TOL keeps its X; skipping an M-step never lowers Q, so this
+        # is still a generalized EM step.
+        genes = range(self.NG)
+        if self.schedule:
+            zChange = np.fabs(self.Z - prevZ)[0]
+            genes = [g for g in genes if self.xChange[g] >= SKIP_TOL or zChange[g] >= SKIP_TOL]
+            print('Skipping ' + str(self.NG - len(genes)) + ' genes')
  
-        for g in range(self.NG):
-            self.optimizeQ(g, t)
-            #pass
+        if self.workers > 1:
+            self.optimizeParallel(genes, t)
+        else:
+            for g in genes:
+                self.optimizeQ(g, t)
+                #pass
+        return
+    
+    #@profile
+    def optimizeParallel(self, genes, t):
+        # Genes are independent given Mu and Z. The pool lives until work()
+        # ends, and the largest genes go first so the tail of the M-step is
+        # made of small ones.
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers, initialWorker, (self,))
+        order = sorted(genes, key = lambda g: -self.NX[g])
+        tasks = [(g, self.coef[g], self.X[g], t, self.tolerance) for g in order]
+        for g, x, fun, message, elapsed in self.pool.imap_unordered(optimizeGene, tasks):
+            print('Gene ' + str(g))
+            print(fun)
+            print(message)
+            self.xChange[g] = np.fabs(x - np.asarray(self.X[g]).ravel()).max()
+            self.X[g] = np.matrix(x)
+            print(self.X[g].sum())
+            print('Time: ' + str(elapsed) + ' s')
         return
     
     #@profile
@@ -247,10 +278,70 @@ class EMAlgorithm:
         # print((self.A[g].dot(self.X[g].T) >= 0).all())
         # print(np.ones((1, self.NX[g])).dot(self.X[g].T))
         #===================================================================
+        res = self.solveQ(g, xInit, t, self.tolerance)
+
+        #=======================================================================
+        #     print(res.fun)
+        #     if res.fun[0, 0] < glopt:
+        #         finres = res
+        #         glopt = res.fun[0, 0]
+        # print(finres)
+        #=======================================================================
+        print(res.fun)
+        print(res.message)
+        self.xChange[g] = np.fabs(res.x - np.asarray(self.X[g]).ravel()).max()
+        self.X[g] = np.matrix(res.x)               
+        print(self.X[g].sum())
+        
+        #=======================================================================
+        #     print(res[1])
+        #     if res[1][0, 0] < glopt:
+        #         finres = res
+        #         glopt = res[1][0, 0]
+        # print(finres)
+        # self.X[g] = np.matrix(finres[0])
+        #=======================================================================
+        print('Time: ' + str(time.clock() - timeSt) + ' s')
+        return
+    
+    #@profile
+    def solveQ(self, g, xInit, t, tolerance):
+        # The multiplicative engine keeps its answer when it satisfies A[g];
+        # otherwise SLSQP runs from the caller's X, as the SLSQP engine would
+        # (started from the infeasible point it ends infeasible too), and the
+        # previous X is kept when it is the only feasible point.
+        if self.engine != ENGINE_MULTIPLICATIVE:
+            return self.slsqpQ(g, xInit, t, tolerance)
+        res = self.multiplicativeQ(g, xInit, t)
+        if self.feasible(g, res.x):
+            return res
+        res = self.slsqpQ(g, xInit, t, tolerance)
+        if not self.feasible(g, res.x) and self.feasible(g, xInit):
+            xInit = np.asarray(xInit, dtype = np.float64).ravel()
+            return opt.OptimizeResult(x = xInit.copy(), fun = self.QFunction(xInit, g),
+                                      message = 'No feasible update, previous X kept', nit = 0)
+        return res
+
+    #@profile
+    def feasible(self, g, X):
+        X = np.asarray(X).ravel()
+        return ((self.A[g].dot(X) > -CONSTRAINT_TOL).all() and (X > -CONSTRAINT_TOL).all()
+                and np.fabs(X.sum() - 1) < CONSTRAINT_TOL)
+
+    #@profile
+    def slsqpQ(self, g, xInit, t, tolerance):
+        # SLSQP's ftol is absolute, so a scheduled tolerance is taken
+        # relative to Q at the start point. Only x0 carries over between
+        # calls: scipy does not expose the multipliers or active set.
+        ftol = self.EPS
+        if tolerance > self.EPS:
+            ftol = max(tolerance * np.fabs(self.QFunction(xInit, g)), self.EPS)
+            if not np.isfinite(ftol):
+                ftol = self.EPS
         res = opt.minimize(fun = self.QFunction,
                            x0 = xInit,
                            args = (g,),
-                           tol = self.EPS, 
+                           tol = ftol, 
                            bounds = [(0, 1) for i in range(self.NX[g])],
                            method = 'SLSQP',
                            jac = self.QDerivate,
@@ -262,7 +353,7 @@ class EMAlgorithm:
                                            'jac':lambda X: np.ones((1, self.NX[g]))}),
                            options = {#'eps' : 1000,
                                       'maxiter' : t,
-                                      'ftol' : self.EPS,
+                                      'ftol' : ftol,
                                       #'disp' : True
                                       }
                        )
@@ -283,53 +374,54 @@ class EMAlgorithm:
         #                      full_output = True, 
         #                      epsilon = self.EPS)
         #===================================================================            
-
-        #=======================================================================
-        #     print(res.fun)
-        #     if res.fun[0, 0] < glopt:
-        #         finres = res
-        #         glopt = res.fun[0, 0]
-        # print(finres)
-        #=======================================================================
-        print(res.fun)
-        print(res.message)
-        self.X[g] = np.matrix(res.x)               
-        print(self.X[g].sum())
-        
-        #=======================================================================
-        #     print(res[1])
-        #     if res[1][0, 0] < glopt:
-        #         finres = res
-        #         glopt = res[1][0, 0]
-        # print(finres)
-        # self.X[g] = np.matrix(finres[0])
-        #=======================================================================
-        print('Time: ' + str(time.clock() - timeSt) + ' s')
-        return
+        return res
+    
+    #@profile
+    def multiplicativeQ(self, g, xInit, t):
+        # EM update of mixture weights, X <- X * Tau^T (coef / Tau X) / sum(coef):
+        # it stays on the simplex and its fixed point maximizes the Q
+        # function there, without the A[g] constraints.
+        X = np.asarray(xInit, dtype = np.float64).ravel().copy()
+        total = self.coef[g].sum()
+        nit = 0
+        message = 'Multiplicative update hit the iteration limit'
+        while nit < t and total > 0:
+            nit += 1
+            denom = self.TauLocal[g].dot(X)
+            ratio = np.divide(self.coef[g], denom, out = np.zeros_like(denom), where = denom > 0)
+            nextX = X * self.TauLocal[g].T.dot(ratio) / total
+            nextX /= nextX.sum()
+            change = np.fabs(nextX - X).max()
+            X = nextX
+            if change < MULTIPLICATIVE_TOL:
+                message = 'Multiplicative update converged'
+                break
+        return opt.OptimizeResult(x = X, fun = self.QFunction(X, g), message = message, nit = nit)
     
     #@profile 
     def offlineProcess(self):
+        # Mu[s, g] * W[s] over the local rows of gene g
         self.coef = []
         for g in range(self.NG):
-            self.coef.append(spa.lil_matrix(self.Mu[g].multiply(self.W.T)))
+            self.coef.append(self.Mu[self.geneSegs[g]] * self.W[0, self.geneRows[g]])
         return
     
     #@profile 
     def QFunction(self, X, g):
-        X = np.matrix(X)
+        X = np.asarray(X).ravel()
         #temp = self.Tau[:,self.NXSUM[g]:self.NXSUM[g+1]].dot(X.T)
-        temp = self.Tau[g].dot(X.T)
+        temp = self.TauLocal[g].dot(X)
         
         #=======================================================================
         # if not (not (self.Mu[:g] > self.EPS) or temp > self.EPS).all():
         #     return np.matrix(float('inf'))
         #=======================================================================
         #return -self.Mu[:,g].multiply(np.log(temp)).T.dot(self.W.T)
-        return -self.coef[g].T.dot(np.log(temp))
+        return -self.coef[g].dot(np.log(temp))
     
     #@profile
     def QDerivate(self, X, g):
-        X = np.matrix(X)
+        X = np.asarray(X).ravel()
         
         #=======================================================================
         # den = (self.Tau[:,self.NXSUM[g]:self.NXSUM[g+1]].dot(X.T)).dot(np.ones((1, self.NX[g])))
@@ -340,14 +432,14 @@ class EMAlgorithm:
         
         #coef = self.Mu[:,g].multiply(self.W.T)
         #denom = self.Tau[:, self.NXSUM[g]:self.NXSUM[g+1]].dot(X.T)
-        denom = self.Tau[g].dot(X.T)
+        denom = self.TauLocal[g].dot(X)
         #temp = np.divide(coef, denom)
-        temp = np.divide(self.coef[g].todense(), denom)
+        temp = np.divide(self.coef[g], denom)
         #jac = self.Tau[:, self.NXSUM[g]:self.NXSUM[g+1]].T.dot(temp).T
-        jac = self.Tau[g].T.dot(temp).T
+        jac = self.TauLocal[g].T.dot(temp)
         
         jac /= np.sum(jac)
-        return -jac.A1
+        return -jac
          
     #===========================================================================
     # def likelihoodFunction(self, x):
@@ -381,7 +473,16 @@ class EMAlgorithm:
                 e += 1
 
     #@profile
-    def work(self, time):
+    def work(self, time, engine = ENGINE_SLSQP, schedule = False):
+        # schedule: M-steps start at a relative tolerance of TOL_START,
+        # tightened to TOL_SCALE times the largest change in Z of the last
+        # iteration, never loosened, and genes that stopped moving are
+        # skipped. The result always comes from a
+        # pass at full accuracy, run after the loop if the iteration limit
+        # came first.
+        self.engine = engine
+        self.schedule = schedule
+        self.tolerance = TOL_START if schedule else self.EPS
         self.initialVariables()
         self.uniformInit()
         
@@ -393,6 +494,7 @@ class EMAlgorithm:
         #=======================================================================
         prevZ = self.Z.copy()
         print(self.Z)
+        passTolerance = self.EPS
         proc = 0
         #time = 1
         while proc < time:
@@ -401,6 +503,7 @@ class EMAlgorithm:
             proc += 1
             self.eStep()
             self.offlineProcess()
+            passTolerance = self.tolerance
             self.mStep(100)
             
             #===================================================================
@@ -431,12 +534,29 @@ class EMAlgorithm:
             print('Comparing Z...')
             print(prevZ)
             print(self.Z)
-            if (np.fabs(self.Z-prevZ) < 1e-5).all():
+            zChange = np.fabs(self.Z-prevZ).max()
+            converged = zChange < 1e-5
+            if converged and passTolerance <= self.EPS:
                 print('\nConverged!\n')
                 break 
+            elif converged:
+                self.tolerance = self.EPS
+                self.xChange[:] = np.inf
             else:
-                prevZ = self.Z.copy()
+                self.tolerance = min(self.tolerance, max(zChange * TOL_SCALE, self.EPS))
+            prevZ = self.Z.copy()
+        if passTolerance > self.EPS:
+            print('\n\n+++++Final pass at full accuracy...')
+            self.tolerance = self.EPS
+            self.xChange[:] = np.inf
+            self.eStep()
+            self.offlineProcess()
+            self.mStep(100)
         #self.mStep(20)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
         self.computePSI()
         return
 
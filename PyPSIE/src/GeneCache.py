@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+CACHE_VERSION = 1
+PRUNE_SLACK = 2.0
+
+class GeneCache:
+    #@profile
+    def __init__(self, cacheDir, params):
+        # One .npz per gene under cacheDir/genes, named by a hash of the
+        # parameters and of the gene's content, so entries of unchanged genes
+        # are found again whatever the rest of the annotation looks like.
+        # Each parameter set has its own directory, pruned to the entries
+        # its latest build used.
+        self.params = json.dumps([CACHE_VERSION, params]).encode()
+        self.genesDir = os.path.join(cacheDir, 'genes')
+        self.path = os.path.join(self.genesDir, hashlib.sha1(self.params).hexdigest())
+        self.buildStart = time.time() - PRUNE_SLACK
+
+    #@profile
+    def key(self, record, exons, strand, junctions, bases):
+        sha = hashlib.sha1(self.params)
+        sha.update(json.dumps([record, exons, strand, junctions]).encode())
+        sha.update(bases.tobytes())
+        return sha.hexdigest()
+
+    #@profile
+    def load(self, key):
+        # (codes, columns within the gene, contributions) or None on a miss
+        entryFile = os.path.join(self.path, key + '.npz')
+        if not os.path.exists(entryFile):
+            return None
+        os.utime(entryFile)
+        entry = np.load(entryFile)
+        return entry['codes'], entry['cols'], entry['vals']
+
+    #@profile
+    def save(self, key, codes, cols, vals):
+        # Renamed into place, so concurrent workers and crashed runs never
+        # leave a half-written entry.
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok = True)
+        entryFile = os.path.join(self.path, key + '.npz')
+        tmpFile = entryFile + '.tmp' + str(os.getpid())
+        entryOut = open(tmpFile, 'wb')
+        np.savez(entryOut, codes = codes, cols = cols, vals = vals)
+        entryOut.close()
+        os.replace(tmpFile, entryFile)
+        return
+
+    #@profile
+    def prune(self):
+        # Called after a complete build: entries neither loaded nor saved
+        # since it started belong to genes that are gone or changed. Loose
+        # files directly under genes/ are from the flat layout of earlier
+        # versions.
+        for folder in [self.path, self.genesDir]:
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                entryFile = os.path.join(folder, name)
+                if not os.path.isfile(entryFile) or '.tmp' in name:
+                    continue
+                if folder == self.genesDir or os.path.getmtime(entryFile) < self.buildStart:
+                    try:
+                        os.remove(entryFile)
+                    except OSError:
+                        pass
+        return
\ No newline at end of file
@@ -0,0 +1,213 @@
+import bisect
+import mmap
+import os
+import numpy as np
+
+PACK_MAGIC = 0x324b5053505950
+PACK_VERSION = 1
+PACK_CHUNK = 1 << 24
+BP_PACK = np.full(256, 4, dtype = np.uint8)
+for c, v in zip(b'ACGTacgt', [0, 1, 2, 3, 0, 1, 2, 3]):
+    BP_PACK[c] = v
+PACK_BP = np.frombuffer(b'ACGTN', dtype = np.uint8)
+
+class GenomeIndex:
+    #@profile
+    def __init__(self, genomeFile, packed = False):
+        # Sequence slices straight from disk through a .fai index (samtools
+        # faidx layout), or through a 2-bit packed copy with N blocks.
+        self.genomeFile = genomeFile
+        self.packed = packed
+        self.readIndex()
+        self.starts = [0]
+        for length in self.lengths:
+            self.starts.append(self.starts[-1] + length)
+        fileIn = open(genomeFile, 'rb')
+        if os.fstat(fileIn.fileno()).st_size > 0:
+            self.data = mmap.mmap(fileIn.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            self.data = b''
+        fileIn.close()
+        if packed:
+            self.openPacked()
+
+    #@profile
+    def readIndex(self):
+        faiFile = self.genomeFile + '.fai'
+        if not os.path.exists(faiFile) or os.path.getmtime(faiFile) < os.path.getmtime(self.genomeFile):
+            self.buildIndex(faiFile)
+        self.names = []
+        self.lengths = []
+        self.offsets = []
+        self.lineBases = []
+        self.lineWidths = []
+        faiIn = open(faiFile, 'r')
+        for line in faiIn:
+            sub = line.rstrip('\n').split('\t')
+            self.names.append(sub[0])
+            self.lengths.append(int(sub[1]))
+            self.offsets.append(int(sub[2]))
+            self.lineBases.append(int(sub[3]))
+            self.lineWidths.append(int(sub[4]))
+        faiIn.close()
+        self.nameIdx = dict(zip(self.names, range(len(self.names))))
+        return
+
+    #@profile
+    def buildIndex(self, faiFile):
+        # All lines of a record but the last must have the same length,
+        # otherwise offsets cannot be computed.
+        records = []
+        genomeIn = open(self.genomeFile, 'rb')
+        pos = 0
+        name = None
+        length, offset, lineBases, lineWidth, short = 0, 0, 0, 0, False
+        for line in genomeIn:
+            if line[:1] == b'>':
+                if name is not None:
+                    records.append((name, length, offset, lineBases, lineWidth))
+                fields = line[1:].split()
+                name = fields[0].decode('ascii', 'replace') if len(fields) > 0 else ''
+                offset = pos + len(line)
+                length = 0
+                lineBases = 0
+                lineWidth = 0
+                short = False
+            elif name is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if bases > 0:
+                    if short:
+                        raise ValueError('Different line length in sequence ' + name + ' of ' + self.genomeFile)
+                    if lineBases == 0:
+                        lineBases = bases
+                        lineWidth = len(line)
+                    elif bases > lineBases:
+                        raise ValueError('Different line length in sequence ' + name + ' of ' + self.genomeFile)
+                    short = bases < lineBases or len(line) < lineWidth
+                    length += bases
+            pos += len(line)
+        if name is not None:
+            records.append((name, length, offset, lineBases, lineWidth))
+        genomeIn.close()
+        faiOut = open(faiFile, 'w')
+        for record in records:
+            faiOut.write('\t'.join([str(x) for x in record]) + '\n')
+        faiOut.close()
+        return
+
+    #@profile
+    def fetch(self, name, st, ed):
+        return self.fetchRecord(self.nameIdx[name], st, ed)
+
+    #@profile
+    def fetchRecord(self, r, st, ed):
+        # ASCII bases [st, ed) of record r as a uint8 array, clipped to the
+        # record.
+        st = max(st, 0)
+        ed = min(ed, self.lengths[r])
+        if st >= ed:
+            return np.zeros(0, dtype = np.uint8)
+        if self.packed:
+            return self.fetchPacked(self.starts[r] + st, self.starts[r] + ed)
+        lineBases = self.lineBases[r]
+        lineWidth = self.lineWidths[r]
+        byteSt = self.offsets[r] + st // lineBases * lineWidth + st % lineBases
+        byteEd = self.offsets[r] + (ed - 1) // lineBases * lineWidth + (ed - 1) % lineBases + 1
+        raw = self.data[byteSt:byteEd]
+        if lineWidth > lineBases:
+            raw = raw.replace(b'\n', b'').replace(b'\r', b'')
+        return np.frombuffer(raw, dtype = np.uint8)
+
+    #@profile
+    def fetchGlobal(self, st, ed):
+        # The legacy coordinates: all records concatenated in file order,
+        # as the exon boundary file uses them.
+        st = max(st, 0)
+        ed = min(ed, self.starts[-1])
+        parts = [np.zeros(0, dtype = np.uint8)]
+        r = bisect.bisect_right(self.starts, st) - 1
+        while st < ed:
+            recEd = min(ed, self.starts[r + 1])
+            parts.append(self.fetchRecord(r, st - self.starts[r], recEd - self.starts[r]))
+            st = recEd
+            r += 1
+        if len(parts) == 2:
+            return parts[1]
+        return np.concatenate(parts)
+
+    #@profile
+    def openPacked(self):
+        packFile = self.genomeFile + '.pk2'
+        if not os.path.exists(packFile) or os.path.getmtime(packFile) < os.path.getmtime(self.genomeFile):
+            self.buildPacked(packFile)
+        header = np.fromfile(packFile, dtype = np.int64, count = 4)
+        if len(header) < 4 or header[0] != PACK_MAGIC or header[1] != PACK_VERSION or header[2] != self.starts[-1]:
+            self.buildPacked(packFile)
+            header = np.fromfile(packFile, dtype = np.int64, count = 4)
+        total = int(header[2])
+        blocks = int(header[3])
+        self.blockStarts = np.fromfile(packFile, dtype = np.int64, count = blocks, offset = 32)
+        self.blockEnds = np.fromfile(packFile, dtype = np.int64, count = blocks, offset = 32 + 8 * blocks)
+        if total > 0:
+            self.bits = np.memmap(packFile, dtype = np.uint8, mode = 'r', offset = 32 + 16 * blocks,
+                                  shape = ((total + 3) // 4,))
+        else:
+            self.bits = np.zeros(0, dtype = np.uint8)
+        return
+
+    #@profile
+    def buildPacked(self, packFile):
+        # Four bases per byte, the first one in the high bits. Anything but
+        # ACGT is stored as A and listed in the N blocks.
+        packed = self.packed
+        self.packed = False
+        total = self.starts[-1]
+        bits = []
+        blockStarts = [np.zeros(0, dtype = np.int64)]
+        blockEnds = [np.zeros(0, dtype = np.int64)]
+        for st in range(0, total, PACK_CHUNK):
+            codes = BP_PACK[self.fetchGlobal(st, st + PACK_CHUNK)]
+            isN = np.zeros(len(codes) + 2, dtype = np.int8)
+            isN[1:-1] = codes > 3
+            edge = np.diff(isN)
+            blockStarts.append(np.flatnonzero(edge == 1) + st)
+            blockEnds.append(np.flatnonzero(edge == -1) + st)
+            codes[codes > 3] = 0
+            codes = np.concatenate((codes, np.zeros(-len(codes) % 4, dtype = np.uint8))).reshape(-1, 4)
+            bits.append((codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3])
+        self.packed = packed
+        blockStarts = np.concatenate(blockStarts)
+        blockEnds = np.concatenate(blockEnds)
+        # Blocks cut at a chunk border are joined again
+        keep = np.ones(len(blockStarts), dtype = bool)
+        keep[1:] = blockStarts[1:] != blockEnds[:-1]
+        keepEnd = np.ones(len(blockEnds), dtype = bool)
+        keepEnd[:-1] = keep[1:]
+        blockStarts = blockStarts[keep]
+        blockEnds = blockEnds[keepEnd]
+        header = np.array([PACK_MAGIC, PACK_VERSION, total, len(blockStarts)], dtype = np.int64)
+        tmpFile = packFile + '.tmp' + str(os.getpid())
+        packOut = open(tmpFile, 'wb')
+        packOut.write(header.tobytes())
+        packOut.write(blockStarts.tobytes())
+        packOut.write(blockEnds.tobytes())
+        for chunk in bits:
+            packOut.write(chunk.tobytes())
+        packOut.close()
+        os.replace(tmpFile, packFile)
+        return
+
+    #@profile
+    def fetchPacked(self, st, ed):
+        bits = self.bits[st // 4:(ed + 3) // 4]
+        codes = np.empty((len(bits), 4), dtype = np.uint8)
+        codes[:, 0] = bits >> 6
+        codes[:, 1] = (bits >> 4) & 3
+        codes[:, 2] = (bits >> 2) & 3
+        codes[:, 3] = bits & 3
+        codes = codes.reshape(-1)[st % 4:st % 4 + ed - st]
+        lo = np.searchsorted(self.blockEnds, st, side = 'right')
+        hi = np.searchsorted(self.blockStarts, ed, side = 'left')
+        for b in range(lo, hi):
+            codes[max(self.blockStarts[b], st) - st:min(self.blockEnds[b], ed) - st] = 4
+        return PACK_BP[codes]
\ No newline at end of file
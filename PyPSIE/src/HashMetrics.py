@@ -0,0 +1,113 @@
+import json
+import os
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class HashMetrics:
+    #@profile
+    def __init__(self, metricsFile = None, callback = None, interval = 5.0):
+        # Stage timers, counters and gauges of the hashing stage. Records
+        # go as JSON lines to metricsFile and/or to callback(record), a
+        # progress record at most every interval seconds and one record at
+        # the end of every stage. Without either it only keeps the numbers.
+        self.metricsFile = metricsFile
+        self.callback = callback
+        self.interval = interval
+        self.pid = os.getpid()
+        self.timeSt = time.time()
+        self.lastEmit = self.timeSt
+        self.counters = {'reads': 0, 'kmers': 0, 'bytesRead': 0, 'genes': 0}
+        self.gauges = {'tableSize': 0}
+        self.stages = {}
+        self.stage = None
+        self.stageSt = None
+        self.stageCounters = None
+
+    def __getstate__(self):
+        # Pool workers get a silent copy (forked ones are silenced by the
+        # pid check); their counts are sent back with their results.
+        state = dict(self.__dict__)
+        state['metricsFile'] = None
+        state['callback'] = None
+        return state
+
+    #@profile
+    def start(self, stage):
+        self.stage = stage
+        self.stageSt = time.time()
+        self.stageCounters = dict(self.counters)
+        return
+
+    #@profile
+    def stop(self):
+        if self.stage is None:
+            return
+        self.stages[self.stage] = self.stages.get(self.stage, 0.0) + time.time() - self.stageSt
+        self.emit('stage')
+        self.stage = None
+        return
+
+    #@profile
+    def add(self, **counts):
+        for name, value in counts.items():
+            self.counters[name] += value
+        now = time.time()
+        if now - self.lastEmit >= self.interval:
+            self.emit('progress', now)
+        return
+
+    #@profile
+    def gauge(self, **values):
+        self.gauges.update(values)
+        return
+
+    #@profile
+    def rss(self):
+        # Current resident set size from /proc, else the peak from getrusage
+        try:
+            statm = open('/proc/self/statm', 'r')
+            pages = int(statm.read().split()[1])
+            statm.close()
+            return pages * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            pass
+        if resource is not None:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return 0
+
+    #@profile
+    def record(self, event, now = None):
+        # Rates are over the current stage so far
+        if now is None:
+            now = time.time()
+        record = {'event': event, 'time': now - self.timeSt, 'stage': self.stage, 'rss': self.rss()}
+        record.update(self.counters)
+        record.update(self.gauges)
+        if self.stage is not None:
+            elapsed = now - self.stageSt
+            record['stageTime'] = elapsed
+            for name, rate in [('reads', 'readsPerSec'), ('kmers', 'kmersPerSec'),
+                               ('bytesRead', 'bytesPerSec'), ('genes', 'genesPerSec')]:
+                done = self.counters[name] - self.stageCounters[name]
+                record[rate] = done / elapsed if elapsed > 0 else 0.0
+        record['stages'] = dict(self.stages)
+        return record
+
+    #@profile
+    def emit(self, event, now = None):
+        if now is None:
+            now = time.time()
+        self.lastEmit = now
+        if (self.metricsFile is None and self.callback is None) or os.getpid() != self.pid:
+            return
+        record = self.record(event, now)
+        if self.metricsFile is not None:
+            metricsOut = open(self.metricsFile, 'a')
+            metricsOut.write(json.dumps(record) + '\n')
+            metricsOut.close()
+        if self.callback is not None:
+            self.callback(record)
+        return
\ No newline at end of file
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+CACHE_VERSION = 4
+SAMPLE_SIZE = 1 << 20
+KEEP_ENTRIES = 4
+ARRAYS = ['kmerCodes', 'W', 'indptr', 'indices', 'data', 'lengthCount', 'junctions']
+
+class KmerCache:
+    #@profile
+    def __init__(self, cacheDir, params, files, arrays = ARRAYS):
+        self.cacheDir = cacheDir
+        self.arrays = arrays
+        self.fingerprint = self.computeFingerprint(params, files)
+        self.path = os.path.join(cacheDir, self.fingerprint)
+
+    #@profile
+    def computeFingerprint(self, params, files):
+        # Parameters plus, per input file, its path, size, mtime and the
+        # first and last megabyte; the files are never read in full.
+        sha = hashlib.sha1()
+        sha.update(json.dumps([CACHE_VERSION, params]).encode())
+        for fileName in files:
+            stat = os.stat(fileName)
+            sha.update(json.dumps([os.path.abspath(fileName), stat.st_size, stat.st_mtime_ns]).encode())
+            fileIn = open(fileName, 'rb')
+            sha.update(fileIn.read(SAMPLE_SIZE))
+            if stat.st_size > SAMPLE_SIZE:
+                fileIn.seek(-SAMPLE_SIZE, 2)
+                sha.update(fileIn.read())
+            fileIn.close()
+        return sha.hexdigest()
+
+    #@profile
+    def load(self):
+        # Header and memory-mapped arrays, or None on a miss.
+        headerFile = os.path.join(self.path, 'header.json')
+        if not os.path.exists(headerFile):
+            return None
+        header = json.load(open(headerFile, 'r'))
+        if header['version'] != CACHE_VERSION or header['fingerprint'] != self.fingerprint:
+            return None
+        # The header's mtime is the entry's last use, see prune()
+        os.utime(headerFile)
+        arrays = {}
+        for name in self.arrays:
+            arrays[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode = 'r')
+        return header, arrays
+
+    #@profile
+    def save(self, header, arrays):
+        # Written next to the final directory and renamed into place, so a
+        # crashed run never leaves a half-written entry behind.
+        header = dict(header, version = CACHE_VERSION, fingerprint = self.fingerprint, arrays = self.arrays)
+        tmpPath = self.path + '.tmp' + str(os.getpid())
+        if os.path.exists(tmpPath):
+            shutil.rmtree(tmpPath)
+        os.makedirs(tmpPath)
+        for name in self.arrays:
+            np.save(os.path.join(tmpPath, name + '.npy'), arrays[name])
+        json.dump(header, open(os.path.join(tmpPath, 'header.json'), 'w'))
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(tmpPath, self.path)
+        self.prune()
+        return
+
+    #@profile
+    def prune(self):
+        # Keeps the KEEP_ENTRIES most recently used entries of this kind
+        # (same arrays: tables or counts) and drops entries of other cache
+        # versions; directories being written are left alone.
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            headerFile = os.path.join(self.cacheDir, name, 'header.json')
+            if '.tmp' in name or not os.path.exists(headerFile):
+                continue
+            try:
+                header = json.load(open(headerFile, 'r'))
+            except ValueError:
+                continue
+            if header.get('version') != CACHE_VERSION:
+                shutil.rmtree(os.path.join(self.cacheDir, name), ignore_errors = True)
+            elif header.get('arrays') == self.arrays:
+                entries.append((os.path.getmtime(headerFile), name))
+        entries.sort(reverse = True)
+        for lastUse, name in entries[KEEP_ENTRIES:]:
+            shutil.rmtree(os.path.join(self.cacheDir, name), ignore_errors = True)
+        return
\ No newline at end of file
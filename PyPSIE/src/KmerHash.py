@@ -1,76 +1,802 @@
-import json
+import collections
+import functools
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import numpy as np
+import scipy.sparse as spa
+from ReadParser import ReadParser
+from KmerCache import KmerCache
+from GeneCache import GeneCache
+from BloomFilter import BloomFilter, mixHash
+from HashMetrics import HashMetrics
+from GenomeIndex import GenomeIndex
+from Annotation import Annotation
+
+BP_CODE = {'A' : 0, 'C' : 1, 'G' : 2, 'T' : 3,
+           'a' : 0, 'c' : 1, 'g' : 2, 't' : 3}
+CODE_BP = 'ACGT'
+BP_DIGIT = bytes.maketrans(b'ACGTacgt', b'01230123')
+BP_ANTI_DIGIT = bytes.maketrans(b'ACGTacgt', b'32103210')
+BP_ARRAY = np.full(256, 4, dtype = np.uint8)
+for c in BP_CODE:
+    BP_ARRAY[ord(c)] = BP_CODE[c]
+BP_ANTI = np.array([3, 2, 1, 0, 4], dtype = np.uint8)
+BATCH_SIZE = 10000
+CHUNKS_PER_WORKER = 8
+MERGE_BLOCK = 1 << 16
+BLOOM_HASHES = 4
+SHARD_HASH = np.uint64(0x9E3779B97F4A7C15)
+QUANT = float(1 << 40)
+JUNCTION_ALL = 'all'
+JUNCTION_ANNOTATED = 'annotated'
+JUNCTION_DISTANCE = 'distance'
+JUNCTION_READS = 'reads'
+COUNT_ARRAYS = ['kmerCodes', 'W', 'lengthCount']
+
+def mergeCounts(runs):
+    # Sort-and-reduce a list of (codes, counts) runs into one sorted run.
+    if len(runs) == 0:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+    codes = np.concatenate([run[0] for run in runs])
+    counts = np.concatenate([run[1] for run in runs])
+    if len(codes) == 0:
+        return codes, counts
+    order = np.argsort(codes, kind = 'mergesort')
+    codes = codes[order]
+    counts = counts[order]
+    head = np.ones(len(codes), dtype = bool)
+    head[1:] = codes[1:] != codes[:-1]
+    start = np.flatnonzero(head)
+    return codes[start], np.add.reduceat(counts, start)
+
+def pushRun(runs, run):
+    # Runs are kept with roughly halving sizes, so every count is re-merged
+    # only O(log n) times however many batches there are.
+    runs.append(run)
+    while len(runs) > 1 and len(runs[-2][0]) <= 2 * len(runs[-1][0]):
+        runs[-2:] = [mergeCounts(runs[-2:])]
+
+def runBytes(runs):
+    return sum([codes.nbytes + counts.nbytes for codes, counts in runs])
+
+def spillRuns(runs, spillDir):
+    # The runs held in memory merged into one sorted (n x 2) run on disk
+    codes, counts = mergeCounts(runs)
+    runHandle, runFile = tempfile.mkstemp(suffix = '.npy', dir = spillDir)
+    os.close(runHandle)
+    np.save(runFile, np.stack((codes, counts), axis = 1))
+    runs[:] = []
+    return runFile
+
+def mergeRunFiles(runFiles, blockSize):
+    # Blockwise k-way merge of sorted runs on disk. Every round reads at
+    # most blockSize entries per run and takes from each run the codes up
+    # to the smallest last code read, so a code is finished in the round
+    # it is merged and the output comes out sorted.
+    runs = [np.load(runFile, mmap_mode = 'r') for runFile in runFiles]
+    pos = [0] * len(runs)
+    codes = [np.zeros(0, dtype = np.int64)]
+    counts = [np.zeros(0, dtype = np.int64)]
+    while True:
+        active = [i for i in range(len(runs)) if pos[i] < len(runs[i])]
+        if len(active) == 0:
+            break
+        cut = min([runs[i][min(pos[i] + blockSize, len(runs[i])) - 1, 0] for i in active])
+        parts = []
+        for i in active:
+            block = runs[i][pos[i]:pos[i] + blockSize]
+            ed = np.searchsorted(block[:, 0], cut, side = 'right')
+            parts.append((np.array(block[:ed, 0]), np.array(block[:ed, 1])))
+            pos[i] += ed
+        blockCodes, blockCounts = mergeCounts(parts)
+        codes.append(blockCodes)
+        counts.append(blockCounts)
+    return np.concatenate(codes), np.concatenate(counts)
+
+def lookupCodes(index, codes):
+    # Position of every code in the sorted index, -1 where it is missing.
+    codes = np.asarray(codes, dtype = np.int64)
+    if len(index) == 0:
+        return np.full(len(codes), -1, dtype = np.int64)
+    pos = np.searchsorted(index, codes)
+    pos[pos == len(index)] = 0
+    return np.where(index[pos] == codes, pos, -1)
+
+def segmentIndex(starts, lens):
+    # Flat positions of the segments [starts[i], starts[i] + lens[i]) and
+    # the offset of every position inside its segment.
+    total = int(lens.sum())
+    offs = np.arange(total) - np.repeat(np.cumsum(lens) - lens, lens)
+    return np.repeat(starts, lens) + offs, offs
+
+def sumTriplets(rows, cols, vals, NW, NC):
+    # Sort-and-segment-sum of (row, column, value) triplets straight into
+    # an NW x NC CSR matrix; repeated pairs are summed in input order.
+    key = rows * NC + cols
+    order = np.argsort(key, kind = 'mergesort')
+    key = key[order]
+    head = np.ones(len(key), dtype = bool)
+    head[1:] = key[1:] != key[:-1]
+    start = np.flatnonzero(head)
+    data = np.add.reduceat(vals[order], start) if len(start) > 0 else np.zeros(0)
+    key = key[start]
+    indptr = np.zeros(NW + 1, dtype = np.int64)
+    np.cumsum(np.bincount(key // NC, minlength = NW), out = indptr[1:])
+    return spa.csr_matrix((data, key % NC, indptr), shape = (NW, NC))
+
+def splitShards(codes, counts, shards):
+    # Fibonacci hashing spreads consecutive codes evenly over the shards;
+    # each shard stays sorted because the run it is cut from is sorted.
+    shard = (codes.astype(np.uint64) * SHARD_HASH) >> np.uint64(40)
+    shard = (shard % np.uint64(shards)).astype(np.int64)
+    ret = []
+    for s in range(shards):
+        pick = shard == s
+        ret.append((codes[pick], counts[pick]))
+    return ret
+
+def readBatches(reads, batchSize):
+    while True:
+        batch = list(itertools.islice(reads, batchSize))
+        if len(batch) == 0:
+            return
+        yield batch
+
+workerHasher = None
+
+def initialWorker(kmerHasher):
+    global workerHasher
+    workerHasher = kmerHasher
+
+def workerCounts(before):
+    # What a task added to the worker's metric counters; every task returns
+    # it next to its result for the parent to add up.
+    counters = workerHasher.metrics.counters
+    return dict([(name, counters[name] - before[name]) for name in counters])
+
+def countChunk(task):
+    readsFile, batchSize, st, ed, shards = task
+    before = dict(workerHasher.metrics.counters)
+    codes, counts, lengthCount = workerHasher.countRange(readsFile, batchSize, st, ed)
+    return (splitShards(codes, counts, shards), lengthCount), workerCounts(before)
+
+def spillChunk(task):
+    readsFile, batchSize, st, ed, spillDir, budget = task
+    before = dict(workerHasher.metrics.counters)
+    batches = readBatches(ReadParser(readsFile, workerHasher.metrics).reads(st, ed), batchSize)
+    return workerHasher.spillBatches(map(workerHasher.countBatch, batches), spillDir, budget), workerCounts(before)
+
+def countBatchTask(batch):
+    before = dict(workerHasher.metrics.counters)
+    return workerHasher.countBatch(batch), workerCounts(before)
+
+def contributeGenes(task):
+    # Workers open the genome on their own; an mmap cannot be sent over.
+    genomeFile, packedGenome, genes = task
+    before = dict(workerHasher.metrics.counters)
+    genome = GenomeIndex(genomeFile, packedGenome)
+    return workerHasher.contributeGenes(genome, genes, workerHasher.junctionProfile()), workerCounts(before)
+
+def countBatchShards(task):
+    batch, shards = task
+    before = dict(workerHasher.metrics.counters)
+    codes, counts, lengthCount = workerHasher.countBatch(batch)
+    return (splitShards(codes, counts, shards), lengthCount), workerCounts(before)
 
 class KmerHash:
     #@profile
-    def __init__(self, K, readLength, genomeFile, exonBoundaryFile, readsFile):
+    def __init__(self, K, readLength, genomeFile, exonBoundaryFile, readsFile, batchSize = 0, workers = 1, canonical = False, referenceFirst = False, cacheDir = None, packedGenome = False,
+                 junctionModel = JUNCTION_ALL, maxSkip = 2, maxMemory = 0, spillDir = None, prefilter = 0, metrics = None):
         self.K = K
         self.readLength = readLength
-        self.kmerTable = {}
-        self.geneBoundary = []
-        self.readReads(readsFile)
-        self.readGenome(genomeFile, exonBoundaryFile)
+        self.batchSize = batchSize
+        self.workers = workers
+        self.canonical = canonical
+        self.mask = (1 << (2 * K)) - 1
+        # readLength is the longest read; longer reads are clipped to it
+        self.shifts = [list(range(2 * (n - K), -1, -2)) for n in range(readLength + 1)]
+        if junctionModel not in [JUNCTION_ALL, JUNCTION_ANNOTATED, JUNCTION_DISTANCE, JUNCTION_READS]:
+            raise ValueError('Unknown junction model ' + str(junctionModel))
+        self.junctionModel = junctionModel
+        self.maxSkip = maxSkip
+        # maxMemory > 0 (bytes) counts reads out of core, with sorted runs
+        # spilled to a temporary directory under spillDir
+        self.maxMemory = maxMemory
+        self.spillDir = spillDir
+        # prefilter > 0 is the size in bytes of a Bloom filter that keeps
+        # k-mers seen once out of the table
+        self.prefilter = prefilter
+        self.prefilterIndex = None
+        self.refIndex = None
+        self.geneCache = None
+        # Stage timers and throughput; a HashMetrics without outputs if
+        # none is given
+        self.metrics = metrics if metrics is not None else HashMetrics()
+        self.metrics.start('annotation')
+        self.readAnnotation(exonBoundaryFile)
+        self.metrics.stop()
+        cache = None
+        if cacheDir is not None:
+            self.metrics.start('loadCache')
+            cache = KmerCache(cacheDir, [K, readLength, canonical, referenceFirst, junctionModel, maxSkip, prefilter],
+                              [genomeFile, exonBoundaryFile, readsFile])
+            loaded = self.loadCache(cache)
+            self.metrics.stop()
+            if loaded:
+                self.finishMetrics()
+                return
+        genome = GenomeIndex(genomeFile, packedGenome)
+        self.annotation.resolve(genome)
+        if referenceFirst or prefilter > 0:
+            self.metrics.start('referenceIndex')
+            if referenceFirst:
+                self.refIndex = self.buildReferenceIndex(genome)
+            if prefilter > 0:
+                self.prefilterIndex = self.refIndex if referenceFirst else self.buildReferenceIndex(genome)
+            self.metrics.stop()
+        self.metrics.start('counting')
+        self.readReads(readsFile, cacheDir)
+        self.metrics.stop()
+        self.metrics.start('junctions')
+        self.selectJunctions(genome)
+        self.initialIndice()
+        self.metrics.stop()
+        if cacheDir is not None:
+            self.geneCache = GeneCache(cacheDir, [self.K, self.readLength, self.canonical,
+                                                  self.readLengths, self.readWeights])
+        self.metrics.start('contributions')
+        self.readGenome(genome)
+        if self.geneCache is not None:
+            self.geneCache.prune()
+        self.metrics.stop()
+        self.metrics.start('merge')
         self.mergeKmer()
-        json.dump(self.kmerTable, open('../output/kmerTable.json', 'w'))
+        self.metrics.stop()
+        if cache is not None:
+            self.metrics.start('saveCache')
+            self.saveCache(cache)
+            self.metrics.stop()
+        self.finishMetrics()
+
+    #@profile
+    def finishMetrics(self):
+        self.metrics.gauge(tableSize = self.NW, nnz = self.Tau.nnz)
+        self.metrics.emit('done')
+        return
     
     #@profile
-    def readReads(self, readsFile):
-        fileIn = open(readsFile, 'r')
+    def collect(self, results):
+        # Unpacks pool results, adding the workers' counts to the metrics
+        for result, counts in results:
+            self.metrics.add(**counts)
+            yield result
+
+    #@profile
+    def loadCache(self, cache):
+        entry = cache.load()
+        if entry is None:
+            return False
+        header, arrays = entry
+        junctions = np.array(arrays['junctions'])
+        self.junctions = [[] for g in range(self.NG)]
+        for g, ei, ej in junctions.tolist():
+            self.junctions[g].append((ei, ej))
+        self.initialIndice()
+        if header['shape'] != [header['NW'], self.NXSUM[self.NG]] or header['NXSUM'] != self.NXSUM:
+            return False
+        # The arrays stay memory-mapped; csr_matrix keeps them without copying
+        # as long as the index dtypes already match.
+        self.kmerCodes = arrays['kmerCodes']
+        self.W = arrays['W']
+        self.NW = header['NW']
+        self.initialReadLengths(np.array(arrays['lengthCount']))
+        self.Tau = spa.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                  shape = tuple(header['shape']))
+        print('Kmer table loaded from ' + cache.path)
+        return True
+
+    #@profile
+    def saveCache(self, cache):
+        header = {'K': self.K, 'readLength': self.readLength, 'NW': self.NW,
+                  'shape': list(self.Tau.shape), 'NXSUM': self.NXSUM}
+        cache.save(header, {'kmerCodes': self.kmerCodes, 'W': self.W, 'indptr': self.Tau.indptr,
+                            'indices': self.Tau.indices, 'data': self.Tau.data,
+                            'lengthCount': self.lengthCount,
+                            'junctions': np.array([(g, ei, ej) for g in range(self.NG) for ei, ej in self.junctions[g]],
+                                                  dtype = np.int64).reshape(-1, 3)})
+        return
+    
+    #@profile
+    def readReads(self, readsFile, cacheDir = None):
+        # Counts only depend on the reads unless they were restricted to the
+        # reference or prefiltered against it, so they are cached on their
+        # own and survive annotation changes.
+        countCache = None
+        if cacheDir is not None and self.refIndex is None and self.prefilterIndex is None:
+            countCache = KmerCache(cacheDir, ['counts', self.K, self.readLength, self.canonical, self.prefilter],
+                                   [readsFile], COUNT_ARRAYS)
+            entry = countCache.load()
+            if entry is not None:
+                header, arrays = entry
+                self.kmerCodes = arrays['kmerCodes']
+                self.W = np.array(arrays['W'])
+                self.NW = len(self.kmerCodes)
+                self.initialReadLengths(np.array(arrays['lengthCount']))
+                print('Kmer counts loaded from ' + countCache.path)
+                return
+        if self.prefilter > 0:
+            batchSize = self.batchSize if self.batchSize > 0 else BATCH_SIZE
+            codes, counts, lengthCount = self.countReadsFiltered(readsFile, batchSize, self.workers)
+        elif self.maxMemory > 0:
+            batchSize = self.batchSize if self.batchSize > 0 else BATCH_SIZE
+            codes, counts, lengthCount = self.countReadsExternal(readsFile, batchSize, self.workers)
+        elif self.workers > 1:
+            batchSize = self.batchSize if self.batchSize > 0 else BATCH_SIZE
+            codes, counts, lengthCount = self.countReadsParallel(readsFile, batchSize, self.workers)
+        elif self.batchSize > 0 or self.refIndex is not None:
+            # Reference k-mers are looked up in refIndex a batch at a time
+            batchSize = self.batchSize if self.batchSize > 0 else BATCH_SIZE
+            codes, counts, lengthCount = self.countReadsBatch(readsFile, batchSize)
+        else:
+            codes, counts, lengthCount = self.countReads(readsFile)
+        # Row s of the contribution matrix is the k-mer kmerCodes[s]
+        self.kmerCodes = codes
+        self.W = counts.astype(np.float64)
+        self.NW = len(codes)
+        self.initialReadLengths(lengthCount)
+        if countCache is not None:
+            countCache.save({'NW': self.NW}, {'kmerCodes': self.kmerCodes, 'W': self.W, 'lengthCount': lengthCount})
+        return
+    
+    #@profile
+    def initialReadLengths(self, lengthCount):
+        # lengthCount[n] is the number of reads of length n (after clipping);
+        # reads shorter than K hold no k-mer and are left out. Without any
+        # read every read is taken to be readLength long.
+        self.lengthCount = lengthCount
+        lengths = np.flatnonzero(lengthCount)
+        lengths = lengths[lengths >= self.K]
+        if len(lengths) == 0:
+            self.readLengths = [self.readLength]
+            self.readWeights = [1.0]
+        else:
+            self.readLengths = lengths.tolist()
+            self.readWeights = (lengthCount[lengths] / lengthCount[lengths].sum()).tolist()
+        return
+    
+    #@profile
+    def exonLength(self, L):
+        # Expected number of read starts on a segment of length L
+        return sum([w * max(L - R + 1, 0) for R, w in zip(self.readLengths, self.readWeights)])
+    
+    #@profile
+    def junctionLength(self):
+        # Expected number of read starts spanning a junction
+        return sum([w * (R - 1) for R, w in zip(self.readLengths, self.readWeights)])
+    
+    #@profile
+    def countReads(self, readsFile):
+        kmerCount = collections.Counter()
+        lengthCount = np.zeros(self.readLength + 1, dtype = np.int64)
         proc = 0
-        for line in fileIn:
-            if proc % 10000 == 0:
-                print(str(proc) + ' reads processed...')
+        total = 0
+        for read in ReadParser(readsFile, self.metrics).reads():
             proc += 1
-            read = line[:-1]
-            st = 0
-            while st + self.K <= self.readLength:
-                kmer = read[st:st+self.K]
-                if kmer in self.kmerTable:
-                    self.kmerTable[kmer] += 1
-                else:
-                    self.kmerTable[kmer] = 1
-                st += 1
-        self.NW = len(self.kmerTable)
-        for kmer in self.kmerTable:
-            val = self.kmerTable[kmer]
-            self.kmerTable[kmer] = (val, {})
+            if proc == 10000:
+                self.metrics.add(reads = proc, kmers = total)
+                proc = 0
+                total = 0
+            lengthCount[min(len(read), self.readLength)] += 1
+            kmers = self.readKmers(read)
+            total += len(kmers)
+            kmerCount.update(kmers)
+        self.metrics.add(reads = proc, kmers = total)
+        codes, counts = mergeCounts([(np.array(list(kmerCount.keys()), dtype = np.int64),
+                                      np.array(list(kmerCount.values()), dtype = np.int64))])
+        return codes, counts, lengthCount
+    
+    #@profile
+    def countReadsBatch(self, readsFile, batchSize):
+        return self.countRange(readsFile, batchSize, 0, None)
+    
+    #@profile
+    def countReadsParallel(self, readsFile, batchSize, workers):
+        # Every task hands back its counts cut into hash shards; shard s of
+        # all tasks is then merged on its own, so the merges share nothing
+        # and the counts equal the serial ones. The file is cut into several
+        # chunks per worker so that counts, and progress, come back while
+        # the pool is still busy.
+        parser = ReadParser(readsFile, self.metrics)
+        pool = multiprocessing.Pool(workers, initialWorker, (self,))
+        lengthCount = np.zeros(self.readLength + 1, dtype = np.int64)
+        if parser.compressed:
+            # A gzip stream cannot be split, so it is parsed here and only
+            # the batches are counted in the pool.
+            tasks = ((batch, workers) for batch in readBatches(parser.reads(), batchSize))
+            results = pool.imap(countBatchShards, tasks)
+        else:
+            tasks = [(readsFile, batchSize, st, ed, workers) for st, ed in parser.split(workers * CHUNKS_PER_WORKER)]
+            results = pool.imap(countChunk, tasks)
+        shardRuns = [[] for s in range(workers)]
+        for res, chunkLengths in self.collect(results):
+            lengthCount += chunkLengths
+            for s in range(workers):
+                pushRun(shardRuns[s], res[s])
+            self.metrics.gauge(tableSize = sum([len(run[0]) for runs in shardRuns for run in runs]))
+        shards = pool.map(mergeCounts, shardRuns)
+        pool.close()
+        pool.join()
+        codes, counts = mergeCounts(shards)
+        self.metrics.gauge(tableSize = len(codes))
+        return codes, counts, lengthCount
+    
+    #@profile
+    def countRange(self, readsFile, batchSize, st, ed):
+        batches = readBatches(ReadParser(readsFile, self.metrics).reads(st, ed), batchSize)
+        return self.mergeBatches(map(self.countBatch, batches))
+    
+    #@profile
+    def mergeBatches(self, counted):
+        runs = []
+        lengthCount = np.zeros(self.readLength + 1, dtype = np.int64)
+        for codes, counts, batchLengths in counted:
+            pushRun(runs, (codes, counts))
+            lengthCount += batchLengths
+            self.metrics.gauge(tableSize = sum([len(run[0]) for run in runs]))
+        codes, counts = mergeCounts(runs)
+        self.metrics.gauge(tableSize = len(codes))
+        return codes, counts, lengthCount
+    
+    #@profile
+    def countReadsFiltered(self, readsFile, batchSize, workers):
+        # The Bloom filter has to see the batches in order, so workers only
+        # count batches and the filtering is done here.
+        bloom = BloomFilter(self.prefilter, BLOOM_HASHES)
+        batches = readBatches(ReadParser(readsFile, self.metrics).reads(), batchSize)
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, initialWorker, (self,))
+            counted = self.collect(pool.imap(countBatchTask, batches))
+        else:
+            counted = map(self.countBatch, batches)
+        counted = self.filterBatches(counted, bloom)
+        if self.maxMemory > 0:
+            codes, counts, lengthCount = self.countReadsExternal(readsFile, batchSize, 1, counted)
+        else:
+            codes, counts, lengthCount = self.mergeBatches(counted)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        # The first occurrence of every kept k-mer was absorbed by the filter
+        counts += 1
+        measured, expected = bloom.falsePositiveRate()
+        print('Bloom prefilter: ' + '{0:.1f}'.format(self.prefilter / float(1 << 20)) + ' MB, '
+              + str(bloom.inserted) + ' kmers inserted, ' + str(len(codes))
+              + ' kept, false positive rate ' + '{0:.2e}'.format(measured)
+              + ' (expected ' + '{0:.2e}'.format(expected) + ')')
+        return codes, counts, lengthCount
+    
+    #@profile
+    def filterBatches(self, counted, bloom):
+        # A k-mer not yet in the filter is inserted and only kept if it
+        # occurs again in the same batch or is a reference k-mer; it is
+        # passed on with one count less, which is added back at the end.
+        # k-mers already in the filter pass with their full count. A false
+        # positive keeps a singleton, or overcounts a k-mer by one.
+        for codes, counts, batchLengths in counted:
+            new = ~bloom.contains(codes)
+            keep = ~new | (counts > 1)
+            if self.prefilterIndex is not None:
+                keep |= lookupCodes(self.prefilterIndex, codes) >= 0
+            bloom.add(codes[new])
+            yield codes[keep], (counts - new)[keep], batchLengths
+    
+    
+    #@profile
+    def countReadsExternal(self, readsFile, batchSize, workers, counted = None):
+        # Out-of-core counting: runs are spilled to disk whenever they
+        # outgrow the budget and merged from disk block by block at the end.
+        # Workers split the budget and spill on their own; counted batches
+        # handed in are spilled here.
+        parser = ReadParser(readsFile, self.metrics)
+        spillDir = tempfile.mkdtemp(prefix = 'kmerRuns', dir = self.spillDir)
+        try:
+            if counted is not None:
+                results = [self.spillBatches(counted, spillDir, self.maxMemory)]
+            elif workers > 1 and not parser.compressed:
+                tasks = [(readsFile, batchSize, st, ed, spillDir, self.maxMemory // workers)
+                         for st, ed in parser.split(workers * CHUNKS_PER_WORKER)]
+                pool = multiprocessing.Pool(workers, initialWorker, (self,))
+                results = list(self.collect(pool.imap(spillChunk, tasks)))
+                pool.close()
+                pool.join()
+            elif workers > 1:
+                pool = multiprocessing.Pool(workers, initialWorker, (self,))
+                counted = self.collect(pool.imap(countBatchTask, readBatches(parser.reads(), batchSize)))
+                results = [self.spillBatches(counted, spillDir, self.maxMemory)]
+                pool.close()
+                pool.join()
+            else:
+                counted = map(self.countBatch, readBatches(parser.reads(), batchSize))
+                results = [self.spillBatches(counted, spillDir, self.maxMemory)]
+            runFiles = [runFile for files, chunkLengths in results for runFile in files]
+            lengthCount = sum([chunkLengths for files, chunkLengths in results])
+            # A merge round holds a block of every run plus its merge
+            blockSize = max(self.maxMemory // (64 * max(len(runFiles), 1)), MERGE_BLOCK)
+            codes, counts = mergeRunFiles(runFiles, blockSize)
+            self.metrics.gauge(tableSize = len(codes))
+        finally:
+            shutil.rmtree(spillDir, ignore_errors = True)
+        print(str(len(runFiles)) + ' sorted runs merged from disk...')
+        return codes, counts, lengthCount
+    
+    #@profile
+    def spillBatches(self, counted, spillDir, budget):
+        # Merging runs takes about four times their size, so they are
+        # spilled at a quarter of the budget.
+        runs = []
+        runFiles = []
+        lengthCount = np.zeros(self.readLength + 1, dtype = np.int64)
+        for codes, counts, batchLengths in counted:
+            pushRun(runs, (codes, counts))
+            lengthCount += batchLengths
+            if runBytes(runs) * 4 > budget:
+                runFiles.append(spillRuns(runs, spillDir))
+        if len(runs) > 0:
+            runFiles.append(spillRuns(runs, spillDir))
+        return runFiles, lengthCount
+    
+    #@profile
+    def countBatch(self, batch):
+        # Reads are bucketed by length so that each bucket is a dense
+        # (reads x length) matrix without padding.
+        reads = [read[:self.readLength] for read in batch]
+        lengths = np.fromiter(map(len, reads), dtype = np.int64, count = len(reads))
+        lengthCount = np.bincount(lengths, minlength = self.readLength + 1)
+        order = np.argsort(lengths, kind = 'mergesort')
+        bounds = np.cumsum(lengthCount)
+        codes = [np.zeros(0, dtype = np.int64)]
+        for n in range(self.K, self.readLength + 1):
+            if lengthCount[n] > 0:
+                bucket = [reads[i] for i in order[bounds[n] - lengthCount[n]:bounds[n]].tolist()]
+                codes.append(self.countBucket(bucket, n))
+        codes = np.concatenate(codes)
+        self.metrics.add(reads = len(batch), kmers = len(codes))
+        if self.refIndex is not None:
+            codes = codes[self.inReference(codes)]
+        codes, counts = np.unique(codes, return_counts = True)
+        return codes, counts, lengthCount
+    
+    #@profile
+    def countBucket(self, bucket, R):
+        bases = BP_ARRAY[np.frombuffer(b''.join(bucket), dtype = np.uint8)].reshape(len(bucket), R)
+        codes, valid = self.windowCodes(bases)
+        return codes[valid]
+    
+    #@profile
+    def windowCodes(self, bases):
+        # Codes of all K-windows of a (rows x n) base matrix, shifted in
+        # column by column, K vector ops in total; valid marks the windows
+        # without a non-ACGT base.
+        rows, n = bases.shape
+        W = n - self.K + 1
+        if W <= 0:
+            return np.zeros((rows, 0), dtype = np.int64), np.zeros((rows, 0), dtype = bool)
+        codes = np.zeros((rows, W), dtype = np.int64)
+        for j in range(self.K):
+            codes <<= 2
+            codes |= bases[:, j:j+W] & 3
+        if self.canonical:
+            antiCodes = np.zeros((rows, W), dtype = np.int64)
+            for j in range(self.K - 1, -1, -1):
+                antiCodes <<= 2
+                antiCodes |= 3 - (bases[:, j:j+W] & 3)
+            np.minimum(codes, antiCodes, out = codes)
+        bad = np.zeros((rows, n + 1), dtype = np.int32)
+        np.cumsum(bases > 3, axis = 1, out = bad[:, 1:])
+        valid = bad[:, self.K:] == bad[:, :W]
+        return codes, valid
+    
+    #@profile
+    def inReference(self, codes):
+        return lookupCodes(self.refIndex, codes) >= 0
+    
+    #@profile
+    def encodeKmers(self, seq):
+        # Rolling 2-bit code (A=0, C=1, G=2, T=3), the same packing as the
+        # C++ KmerHash::readKmer. Windows covering a non-ACGT base are skipped.
+        # The reverse complement rolls the other way: the complement of the
+        # new base enters at the top.
+        K = self.K
+        mask = self.mask
+        top = 2 * (K - 1)
+        code = 0
+        antiCode = 0
+        valid = 0
+        pos = 1 - K
+        for c in seq:
+            bp = BP_CODE.get(c)
+            if bp is None:
+                valid = 0
+            else:
+                code = ((code << 2) | bp) & mask
+                antiCode = (antiCode >> 2) | ((3 - bp) << top)
+                valid += 1
+                if valid >= K:
+                    if self.canonical and antiCode < code:
+                        yield pos, antiCode
+                    else:
+                        yield pos, code
+            pos += 1
+
+    #@profile
+    def readKmers(self, read):
+        # A clean read is parsed as one base-4 integer, so every k-mer is
+        # just a shift and a mask of it.
+        read = read[:self.readLength]
+        if len(read) >= self.K:
+            shifts = self.shifts[len(read)]
+            digits = read.translate(BP_DIGIT)
+            if digits.isdigit():
+                try:
+                    code = int(digits, 4)
+                    kmers = [(code >> s) & self.mask for s in shifts]
+                    if self.canonical:
+                        # k-mer i of the read is k-mer i from the end of its
+                        # reverse complement
+                        antiCode = int(read[::-1].translate(BP_ANTI_DIGIT), 4)
+                        antiKmers = [(antiCode >> s) & self.mask for s in reversed(shifts)]
+                        kmers = list(map(min, kmers, antiKmers))
+                    return kmers
+                except ValueError:
+                    pass
+        return [kmer for st, kmer in self.encodeKmers(read.decode('ascii', 'replace'))]
+
+    def decodeKmer(self, code):
+        kmer = ''
+        for i in range(self.K):
+            kmer = CODE_BP[code & 3] + kmer
+            code >>= 2
+        return kmer
+
+    #@profile
+    def readAnnotation(self, exonBoundaryFile):
+        # Legacy 4-column file, BED12 or GTF; see Annotation
+        self.annotation = Annotation(exonBoundaryFile)
+        self.NG = self.annotation.NG
+        self.NE = self.annotation.NE
+        print(str(self.NG) + ' genes read from ' + self.annotation.format + ' annotation...')
         return
     
     #@profile
-    def readGenome(self, genomeFile, exonBoundaryFile):
-        exonBoundaryIn = open(exonBoundaryFile,'r')
-        COL_EXONNUM = 1
-        COL_EXONST = 2
-        COL_EXONED = 3
-        for line in exonBoundaryIn:
-            sub = line[:-1].split('\t')
-            self.geneBoundary.append([])
-            subst = sub[COL_EXONST].split(',')
-            subed = sub[COL_EXONED].split(',')
-            e = 0
-            while e < int(sub[COL_EXONNUM]):
-                self.geneBoundary[-1].append((int(subst[e]), int(subed[e])))
-                e += 1
-        exonBoundaryIn.close()
-        
-        self.NG = len(self.geneBoundary)
-        self.NE = []
+    def junctionCandidates(self, g):
+        # Exon pairs (ei, ej), ei < ej, allowed by the junction model before
+        # looking at reads, in lexicographic order.
+        if self.junctionModel == JUNCTION_ANNOTATED:
+            return self.annotation.junctions(g)
+        pairs = []
+        for ei in range(self.NE[g]):
+            for ej in range(ei + 1, self.NE[g]):
+                if self.junctionModel != JUNCTION_DISTANCE or ej - ei - 1 <= self.maxSkip:
+                    pairs.append((ei, ej))
+        return pairs
+    
+    #@profile
+    def selectJunctions(self, genome):
+        # With the reads model a candidate is kept when at least half of the
+        # K-1 k-mers across its splice point were seen in the reads.
+        self.junctions = []
         for g in range(self.NG):
-            self.NE.append(len(self.geneBoundary[g]))
-        
-        #=======================================================================
-        # for g in range(self.NG):
-        #     for e in range(self.NE[g]):
-        #         print(self.geneBoundary[g][e][0], end = '\t')
-        #         print(self.geneBoundary[g][e][1])
-        #=======================================================================
-        
-        genomeIn = open(genomeFile, 'r')
-        geneSeq = ''
-        for line in genomeIn:
-            if '>' not in line:
-                geneSeq += line[:-1]
-        genomeIn.close()
-        
+            pairs = self.junctionCandidates(g)
+            if self.junctionModel == JUNCTION_READS and len(pairs) > 0:
+                first, second = np.array(pairs, dtype = np.int64).T
+                left, right, span = self.flankCodes(genome, g, first, second)
+                codes, valid = span
+                hits = ((lookupCodes(self.kmerCodes, codes.reshape(-1)) >= 0).reshape(codes.shape) & valid).sum(axis = 1)
+                pairs = [pairs[x] for x in np.flatnonzero((hits > 0) & (2 * hits >= self.K - 1)).tolist()]
+            self.junctions.append(pairs)
+        print(str(sum([len(pairs) for pairs in self.junctions])) + ' junctions kept by the '
+              + self.junctionModel + ' junction model...')
+        return
+    
+    #@profile
+    def initialIndice(self):
+        # Global X columns, exons of a gene first and then its junctions in
+        # the order of self.junctions; EMAlgorithm takes the same indexing
+        # over.
+        self.NX = []
+        for g in range(self.NG):
+            self.NX.append(self.NE[g] + len(self.junctions[g]))
+            
+        self.NXSUM = [0]
+        for g in range(self.NG):
+            self.NXSUM.append(self.NX[g] + self.NXSUM[g])
+            
+        self.MergeIdx = {}
+        self.SplitIdx = []
+        idx = 0
+        for g in range(self.NG):
+            for e in range(self.NE[g]):
+                self.SplitIdx.append((g,e,e))
+                self.MergeIdx[(g,e,e)] = idx
+                idx += 1
+            for ei, ej in self.junctions[g]:
+                self.SplitIdx.append((g,ei,ej))
+                self.MergeIdx[(g,ei,ej)] = idx
+                idx += 1
+        return
+    
+    #@profile
+    def geneFetch(self, genome, g):
+        # Base codes of [st, ed) in transcript orientation; minus strand
+        # sequences are fetched by coordinates and reverse-complemented.
+        record = self.annotation.geneRecords[g]
+        fetch = genome.fetchGlobal if record < 0 else functools.partial(genome.fetchRecord, record)
+        if self.annotation.geneStrands[g] < 0:
+            return lambda st, ed: BP_ANTI[BP_ARRAY[fetch(st, ed)][::-1]]
+        return lambda st, ed: BP_ARRAY[fetch(st, ed)]
+    
+    #@profile
+    def exonBases(self, genome, g):
+        fetch = self.geneFetch(genome, g)
+        for e, (st, ed) in enumerate(self.annotation.exons(g)):
+            yield e, fetch(st, ed)
+    
+    #@profile
+    def flankCodes(self, genome, g, first, second):
+        # The junction sequence of (ei, ej) is the 3' flank of ei (its last
+        # R-1 bases) followed by the 5' flank of ej (its first R-1 bases).
+        # Its k-mers come in three parts: R-K inside the 3' flank and R-K
+        # inside the 5' flank, hashed once per exon, and K-1 across the splice
+        # point, the only ones hashed per pair. Flanks cut short by the end
+        # of a sequence are padded with N.
+        R = self.readLength
+        K = self.K
+        fetch = self.geneFetch(genome, g)
+        minus = self.annotation.geneStrands[g] < 0
+        tails = np.full((self.NE[g], R - 1), 4, dtype = np.uint8)
+        heads = np.full((self.NE[g], R - 1), 4, dtype = np.uint8)
+        for e, (st, ed) in enumerate(self.annotation.exons(g)):
+            tail = fetch(st, st + R - 1) if minus else fetch(ed - R + 1, ed)
+            head = fetch(ed - R + 1, ed) if minus else fetch(st, st + R - 1)
+            tails[e, R - 1 - len(tail):] = tail
+            heads[e, :len(head)] = head
+        span = np.hstack((tails[first, R - K:], heads[second, :K - 1]))
+        return self.windowCodes(tails), self.windowCodes(heads), self.windowCodes(span)
+    
+    #@profile
+    def junctionCodes(self, genome, g, pairs):
+        # (codes, valid) of the 2R-K-1 k-mers of every junction sequence,
+        # one row per exon pair.
+        first, second = np.array(pairs, dtype = np.int64).reshape(-1, 2).T
+        left, right, span = self.flankCodes(genome, g, first, second)
+        codes = np.hstack((left[0][first], span[0], right[0][second]))
+        valid = np.hstack((left[1][first], span[1], right[1][second]))
+        return codes, valid
+    
+    #@profile
+    def buildReferenceIndex(self, genome):
+        # Every k-mer of every exon and junction, so that reads can be
+        # counted against the reference instead of the other way round.
+        codes = [np.zeros(0, dtype = np.int64)]
+        for g in range(self.NG):
+            for e, bases in self.exonBases(genome, g):
+                kmers, valid = self.windowCodes(bases.reshape(1, -1))
+                codes.append(kmers[valid])
+            pairs = self.junctionCandidates(g)
+            if len(pairs) > 0:
+                first, second = np.array(pairs, dtype = np.int64).T
+                for kmers, valid in self.flankCodes(genome, g, first, second):
+                    codes.append(kmers[valid])
+        refIndex = np.unique(np.concatenate(codes))
+        print(str(len(refIndex)) + ' reference kmers indexed...')
+        return refIndex
+    
+    #@profile
+    def readGenome(self, genome):
         #=======================================================================
         # self.temp = []
         # self.id = {}
@@ -81,99 +807,207 @@ class KmerHash:
         #     l += 1
         #=======================================================================
         
-        for g in range(self.NG):
-            print('Gene-' + str(g) + ' processed...')
-            for e in range(self.NE[g]):
-                id = str(g) + ',' + str(e) + ',' + str(e)
-                st = self.geneBoundary[g][e][0]
-                ed = self.geneBoundary[g][e][1] + 1
-                
-                l = st
-                while l + self.K <= ed:
-                    kmer = geneSeq[l:l+self.K]
-                    if kmer in self.kmerTable:
-                        contribution = self.kmerContribution(st, ed, l, l + self.K, ed - st)
-                        if id in self.kmerTable[kmer][1]:
-                            self.kmerTable[kmer][1][id] += contribution
-                        else:
-                            self.kmerTable[kmer][1][id] = contribution
-                    l += 1
-            
-                tot = (ed - st - self.readLength + 1) * (self.readLength - self.K + 1)
-                    
-                l = st
-                while l + self.K <= ed:
-                    kmer = geneSeq[l:l+self.K]
-                    if kmer in self.kmerTable:
-                        self.kmerTable[kmer][1][id] /= tot
-                    l += 1
-                    
-            for ei in range(self.NE[g]):
-                for ej in range(ei + 1, self.NE[g]):
-                    id = str(g) + ',' + str(ei) + ',' + str(ej)
-                    edi = self.geneBoundary[g][ei][1] + 1
-                    stj = self.geneBoundary[g][ej][0]
-                    junction = geneSeq[edi - self.readLength + 1:edi] + geneSeq[stj:stj + self.readLength - 1]
-                    
-                    l = 0
-                    while l + self.K <= 2*self.readLength - 2:
-                        kmer = junction[l:l + self.K]
-                        if kmer in self.kmerTable:
-                            contribution = self.kmerContribution(0, 2*self.readLength - 2, l, l + self.K, 2*self.readLength - 2)
-                            if id in self.kmerTable[kmer][1]:
-                                self.kmerTable[kmer][1][id] += contribution 
-                            else:
-                                self.kmerTable[kmer][1][id] = contribution
-                        l += 1
-                        
-                    tot = (2*self.readLength - 2 - self.readLength + 1) * (self.readLength - self.K + 1)
-                        
-                    l = 0
-                    while l + self.K <= 2*self.readLength - 2:
-                        kmer = junction[l:l+self.K]
-                        if kmer in self.kmerTable:
-                            self.kmerTable[kmer][1][id] /= tot
-                        l += 1
+        if self.workers > 1:
+            triplets = self.readGenomeParallel(genome, self.workers)
+        else:
+            triplets = [self.contributeGenes(genome, range(self.NG), self.junctionProfile())]
+        
+        # (kmer row, global X column, contribution) triplets; repeated pairs
+        # are summed into the CSR matrix.
+        rows = np.concatenate([triplet[0] for triplet in triplets])
+        cols = np.concatenate([triplet[1] for triplet in triplets])
+        vals = np.concatenate([triplet[2] for triplet in triplets])
+        self.Tau = sumTriplets(rows, cols, vals, self.NW, self.NXSUM[self.NG])
         return
     
     #@profile
-    def kmerContribution(self, st, ed, l, r, L):
-        cil = min(L - self.readLength + 1, self.readLength - self.K + 1)
-        ret = min(l - st + 1, ed - r + 1)
-        return min(ret, cil)
+    def readGenomeParallel(self, genome, workers):
+        # Genes are independent, so they are dealt out in chunks of about
+        # equal work (exon bases plus junctions), largest genes first.
+        work = [sum(self.annotation.exonLengths(g)) + self.NX[g] * self.readLength for g in range(self.NG)]
+        order = sorted(range(self.NG), key = lambda g: -work[g])
+        chunkWork = max(sum(work) // (workers * 8), 1)
+        tasks = []
+        genes = []
+        load = 0
+        for g in order:
+            genes.append(g)
+            load += work[g]
+            if load >= chunkWork:
+                tasks.append((genome.genomeFile, genome.packed, genes))
+                genes = []
+                load = 0
+        if len(genes) > 0:
+            tasks.append((genome.genomeFile, genome.packed, genes))
+        pool = multiprocessing.Pool(workers, initialWorker, (self,))
+        triplets = list(self.collect(pool.imap_unordered(contributeGenes, tasks)))
+        pool.close()
+        pool.join()
+        return triplets
+    
+    #@profile
+    def contributeGenes(self, genome, genes, junctionProfile):
+        # (kmer row, global X column, contribution) of the given genes,
+        # restricted to k-mers seen in the reads.
+        rows = [np.zeros(0, dtype = np.int64)]
+        cols = [np.zeros(0, dtype = np.int64)]
+        vals = [np.zeros(0)]
+        for g in genes:
+            codes, geneCols, geneVals = self.cachedContributions(genome, g, junctionProfile)
+            kmerRows = lookupCodes(self.kmerCodes, codes)
+            hit = kmerRows >= 0
+            rows.append(kmerRows[hit])
+            cols.append(geneCols[hit])
+            vals.append(geneVals[hit])
+            self.metrics.add(genes = 1)
+        return np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+    
+    #@profile
+    def cachedContributions(self, genome, g, junctionProfile):
+        # Entries hold columns relative to the gene, since the global offset
+        # moves whenever a gene before it changes. The key covers the
+        # coordinates, the junction set and every base the gene's k-mers
+        # can reach.
+        if self.geneCache is None:
+            return self.geneContributions(genome, g, junctionProfile)
+        exons = self.annotation.exons(g)
+        R = self.readLength
+        st = min([exon[0] for exon in exons]) - R
+        ed = max([exon[1] for exon in exons]) + R
+        record = int(self.annotation.geneRecords[g])
+        bases = genome.fetchGlobal(st, ed) if record < 0 else genome.fetchRecord(record, st, ed)
+        key = self.geneCache.key(record, exons, int(self.annotation.geneStrands[g]), self.junctions[g], bases)
+        entry = self.geneCache.load(key)
+        if entry is not None:
+            codes, cols, vals = entry
+            return codes, cols + self.NXSUM[g], vals
+        codes, cols, vals = self.geneContributions(genome, g, junctionProfile)
+        self.geneCache.save(key, codes, cols - self.NXSUM[g], vals)
+        return codes, cols, vals
+    
+    #@profile
+    def geneContributions(self, genome, g, junctionProfile):
+        # (kmer code, global X column, contribution) of every valid k-mer of
+        # the exons and junctions of gene g.
+        codes = []
+        cols = []
+        vals = []
+        for e, bases in self.exonBases(genome, g):
+            profile = self.exonProfile(len(bases))
+            if profile is None:
+                continue
+            kmers, valid = self.windowCodes(bases.reshape(1, -1))
+            codes.append(kmers[valid])
+            cols.append(np.full(valid.sum(), self.NXSUM[g] + e, dtype = np.int64))
+            vals.append(profile[valid[0]])
+        if len(self.junctions[g]) > 0:
+            kmers, valid = self.junctionCodes(genome, g, self.junctions[g])
+            x = np.arange(self.NE[g], self.NX[g]) + self.NXSUM[g]
+            codes.append(kmers[valid])
+            cols.append(np.broadcast_to(x[:, None], valid.shape)[valid])
+            vals.append(np.broadcast_to(junctionProfile, valid.shape)[valid])
+        
+        if len(codes) == 0:
+            return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0)
+        return np.concatenate(codes), np.concatenate(cols), np.concatenate(vals)
+    
+    #@profile
+    def exonProfile(self, L):
+        # Normalized contribution of the k-mer at every offset of an exon of
+        # length L, mixed over the read lengths; None if no read fits in.
+        l = np.arange(max(L - self.K + 1, 0))
+        profile = np.zeros(len(l))
+        tot = 0
+        for R, w in zip(self.readLengths, self.readWeights):
+            profile += w * self.kmerContribution(0, L, l, l + self.K, L, R)
+            tot += w * max(L - R + 1, 0) * (R - self.K + 1)
+        if tot == 0:
+            return None
+        return profile / tot
+    
+    #@profile
+    def junctionProfile(self):
+        # The same for a junction sequence, which is 2*readLength-2 long for
+        # every exon pair; reads of length R span its middle 2R-2 bases.
+        L = 2 * self.readLength - 2
+        l = np.arange(max(L - self.K + 1, 0))
+        profile = np.zeros(len(l))
+        tot = 0
+        for R, w in zip(self.readLengths, self.readWeights):
+            profile += w * self.kmerContribution(self.readLength - R, self.readLength + R - 2,
+                                                 l, l + self.K, 2*R - 2, R)
+            tot += w * (R - 1) * (R - self.K + 1)
+        return profile / tot
+    
+    #@profile
+    def kmerContribution(self, st, ed, l, r, L, R):
+        # Works on scalars and on arrays of k-mer positions alike
+        cil = min(L - R + 1, R - self.K + 1)
+        ret = np.minimum(l - st + 1, ed - r + 1)
+        return np.maximum(np.minimum(ret, cil), 0)
     
     #@profile
     def mergeKmer(self):
-        temp = {}
-        newTable = {}
-        for x in self.kmerTable:
-            keys = sorted(self.kmerTable[x][1].keys())
-            value = str(self.kmerTable[x][0])
-            for y in keys:
-                value += y + str(self.kmerTable[x][1][y])
-            
-            if not value in temp:
-                temp[value] = x
-                newTable[x] = tuple(self.kmerTable[x])
-            else:
-                newx = temp[value]
-                newdic = {}
-                for loc in newTable[newx][1]:
-                    newdic[loc] = newTable[newx][1][loc] + self.kmerTable[x][1][loc]
-                newTable[newx] = (newTable[newx][0] + self.kmerTable[x][0],
-                                  newdic)
-            
-        #=======================================================================
-        # for x in newTable:
-        #     if newTable[x] != self.kmerTable[x]:
-        #         print(x)
-        #         print(newTable[x])
-        #         print(self.kmerTable[x])
-        #=======================================================================
-                    
-            
-        self.kmerTable = newTable
-        self.NW = len(self.kmerTable)
-        #exit()
-        return 
-    
\ No newline at end of file
+        # k-mers with the same count and the same contributions form one
+        # equivalence class and their rows are summed into one. Classes are
+        # found through a 64-bit hash of (count, columns, quantized
+        # contributions); rows are only compared exactly against the first
+        # row with the same hash.
+        rows = np.arange(self.NW)
+        indptr = self.Tau.indptr.astype(np.int64)
+        indices = self.Tau.indices.astype(np.int64)
+        data = self.Tau.data
+        quant = np.rint(data * QUANT).astype(np.int64)
+        nnz = np.diff(indptr)
+        
+        entry = mixHash((indices.astype(np.uint64) << np.uint64(32)) ^ quant.astype(np.uint64))
+        sig = np.zeros(self.NW, dtype = np.uint64)
+        filled = nnz > 0
+        if filled.any():
+            sig[filled] = np.add.reduceat(entry, indptr[:-1][filled])
+        sig = mixHash(sig ^ mixHash(self.W.view(np.uint64) ^ nnz.astype(np.uint64)))
+        
+        order = np.argsort(sig, kind = 'mergesort')
+        head = np.ones(self.NW, dtype = bool)
+        head[1:] = sig[order][1:] != sig[order][:-1]
+        leader = np.empty(self.NW, dtype = np.int64)
+        leader[order] = order[np.maximum.accumulate(np.where(head, np.arange(self.NW), 0))]
+        
+        cand = np.flatnonzero(leader != rows)
+        same = (self.W[cand] == self.W[leader[cand]]) & (nnz[cand] == nnz[leader[cand]])
+        check = cand[same]
+        own, offs = segmentIndex(indptr[check], nnz[check])
+        lead = np.repeat(indptr[leader[check]], nnz[check]) + offs
+        bad = (indices[own] != indices[lead]) | (quant[own] != quant[lead])
+        badRow = np.bincount(np.repeat(np.arange(len(check)), nnz[check]), weights = bad, minlength = len(check)) > 0
+        collided = np.concatenate((cand[~same], check[badRow]))
+        if len(collided) > 0:
+            # Hash collisions (expected almost never) get exact signatures
+            temp = {}
+            for x in np.sort(collided).tolist():
+                value = (self.W[x], indices[indptr[x]:indptr[x+1]].tobytes(),
+                         quant[indptr[x]:indptr[x+1]].tobytes())
+                if not value in temp:
+                    temp[value] = x
+                leader[x] = temp[value]
+        
+        isLeader = leader == rows
+        leaders = np.flatnonzero(isLeader)
+        group = (np.cumsum(isLeader) - 1)[leader]
+        NW = len(leaders)
+        
+        newNnz = nnz[leaders]
+        newIndptr = np.zeros(NW + 1, dtype = np.int64)
+        np.cumsum(newNnz, out = newIndptr[1:])
+        src, offs = segmentIndex(indptr[leaders], newNnz)
+        newIndices = indices[src]
+        members = np.flatnonzero(~isLeader)
+        own, offs = segmentIndex(indptr[members], nnz[members])
+        target = np.repeat(newIndptr[group[members]], nnz[members]) + offs
+        newData = data[src] + np.bincount(target, weights = data[own], minlength = len(src))
+        
+        self.Tau = spa.csr_matrix((newData, newIndices, newIndptr), shape = (NW, self.NXSUM[self.NG]))
+        self.W = np.bincount(group, weights = self.W, minlength = NW)
+        self.kmerCodes = self.kmerCodes[leaders]
+        self.NW = NW
+        return
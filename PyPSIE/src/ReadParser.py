@@ -0,0 +1,191 @@
+import gzip
+
+BLOCK_SIZE = 1 << 22
+FORMAT_RAW = 'raw'
+FORMAT_FASTA = 'fasta'
+FORMAT_FASTQ = 'fastq'
+
+class ReadParser:
+    #@profile
+    def __init__(self, readsFile, metrics = None):
+        self.readsFile = readsFile
+        self.metrics = metrics
+        headIn = open(readsFile, 'rb')
+        self.compressed = headIn.read(2) == b'\x1f\x8b'
+        headIn.close()
+
+        # gzip.open reads every member of a multi-member file, which covers
+        # bgzip output as well.
+        headIn = self.open()
+        head = headIn.read(BLOCK_SIZE).lstrip()
+        headIn.close()
+        if head[:1] == b'@':
+            self.format = FORMAT_FASTQ
+        elif head[:1] == b'>':
+            self.format = FORMAT_FASTA
+        else:
+            # One read per line, as written by ReadGenerator.outputReadFastq
+            self.format = FORMAT_RAW
+        self.crlf = b'\r\n' in head
+
+    def open(self):
+        if self.compressed:
+            return gzip.open(self.readsFile, 'rb')
+        return open(self.readsFile, 'rb')
+
+    #@profile
+    def lineBlocks(self, st = 0, ed = None):
+        # Lists of complete lines from fixed-size binary blocks. [st, ed) has
+        # to come from split() so that it holds whole records.
+        fileIn = self.open()
+        if st > 0:
+            fileIn.seek(st)
+        left = None if ed is None else ed - st
+        rest = b''
+        while left is None or left > 0:
+            block = fileIn.read(BLOCK_SIZE if left is None else min(BLOCK_SIZE, left))
+            if len(block) == 0:
+                break
+            if left is not None:
+                left -= len(block)
+            if self.metrics is not None:
+                self.metrics.add(bytesRead = len(block))
+            lines = (rest + block).split(b'\n')
+            rest = lines.pop()
+            if self.crlf:
+                lines = [line.rstrip(b'\r') for line in lines]
+            yield lines
+        fileIn.close()
+        if len(rest) > 0:
+            yield [rest.rstrip(b'\r')]
+
+    #@profile
+    def records(self, st = 0, ed = None):
+        # (header, sequence, quality) tuples; missing fields are None.
+        if self.format == FORMAT_FASTQ:
+            pending = []
+            for lines in self.lineBlocks(st, ed):
+                pending = self.dropBlankLines(pending + lines)
+                n = len(pending) - len(pending) % 4
+                for i in range(0, n, 4):
+                    self.checkFastq(pending, i)
+                    yield pending[i][1:], pending[i+1], pending[i+3]
+                pending = pending[n:]
+            pending = self.finishFastq(pending)
+            if len(pending) > 0:
+                self.checkFastq(pending, 0)
+                yield pending[0][1:], pending[1], pending[3]
+        elif self.format == FORMAT_FASTA:
+            header = None
+            seq = []
+            for lines in self.lineBlocks(st, ed):
+                for line in lines:
+                    if line[:1] == b'>':
+                        if header is not None:
+                            yield header, b''.join(seq), None
+                        header = line[1:]
+                        seq = []
+                    else:
+                        seq.append(line)
+            if header is not None:
+                yield header, b''.join(seq), None
+        else:
+            for lines in self.lineBlocks(st, ed):
+                for line in lines:
+                    yield None, line, None
+
+    #@profile
+    def reads(self, st = 0, ed = None):
+        if self.format == FORMAT_FASTQ:
+            # Fast path: sequences are every fourth line of a block, only
+            # the first record of each block is checked for alignment.
+            pending = []
+            for lines in self.lineBlocks(st, ed):
+                pending = self.dropBlankLines(pending + lines)
+                n = len(pending) - len(pending) % 4
+                if n > 0:
+                    self.checkFastq(pending, 0)
+                    yield from pending[1:n:4]
+                pending = pending[n:]
+            pending = self.finishFastq(pending)
+            if len(pending) > 0:
+                self.checkFastq(pending, 0)
+                yield pending[1]
+        elif self.format == FORMAT_RAW:
+            for lines in self.lineBlocks(st, ed):
+                yield from lines
+        else:
+            for header, seq, qual in self.records(st, ed):
+                yield seq
+
+    def dropBlankLines(self, lines):
+        # lines starts at a record. Blank lines are skipped only where a
+        # header is due; inside a record they are an empty sequence or
+        # quality (fully trimmed reads).
+        if b'' not in lines[0::4]:
+            return lines
+        kept = []
+        i = 0
+        while i < len(lines):
+            if len(lines[i]) == 0:
+                i += 1
+                continue
+            kept += lines[i:i+4]
+            i += 4
+        return kept
+
+    def finishFastq(self, lines):
+        # The last record may miss its final newline, and with it an empty
+        # quality line.
+        if len(lines) == 3 and len(lines[1]) == 0:
+            lines = lines + [b'']
+        if len(lines) % 4 != 0:
+            raise ValueError('Truncated FASTQ record in ' + self.readsFile)
+        return lines
+
+    def checkFastq(self, lines, i):
+        if lines[i][:1] != b'@' or lines[i+2][:1] != b'+':
+            raise ValueError('Malformed FASTQ record in ' + self.readsFile + ': '
+                             + lines[i][:50].decode('ascii', 'replace'))
+
+    #@profile
+    def split(self, parts):
+        # Byte ranges of about equal size, each moved forward to the start of
+        # the next record. Compressed input cannot be split.
+        if self.compressed:
+            return [(0, None)]
+        fileIn = open(self.readsFile, 'rb')
+        fileIn.seek(0, 2)
+        size = fileIn.tell()
+        bounds = [0]
+        for i in range(1, parts):
+            bound = self.nextRecord(fileIn, max(size * i // parts, bounds[-1]), size)
+            bounds.append(bound)
+        bounds.append(size)
+        fileIn.close()
+        return [(bounds[i], bounds[i+1]) for i in range(parts) if bounds[i] < bounds[i+1]]
+
+    def nextRecord(self, fileIn, pos, size):
+        if pos == 0:
+            return 0
+        fileIn.seek(pos - 1)
+        fileIn.readline()
+        if self.format == FORMAT_RAW:
+            return fileIn.tell()
+        starts = []
+        lines = []
+        while True:
+            starts.append(fileIn.tell())
+            line = fileIn.readline()
+            if len(line) == 0:
+                return size
+            if self.format == FORMAT_FASTA:
+                if line[:1] == b'>':
+                    return starts[-1]
+                starts = []
+                continue
+            # FASTQ: a header is an '@' line whose second next line starts
+            # with '+'; quality lines may start with '@' but never match this.
+            lines.append(line)
+            if len(lines) >= 3 and lines[-3][:1] == b'@' and lines[-1][:1] == b'+':
+                return starts[-3]
@@ -1,4 +1,5 @@
 from KmerHash import KmerHash
+from HashMetrics import HashMetrics
 from EMAlgorithm import EMAlgorithm
 import numpy as np 
 import json
@@ -13,12 +14,30 @@ def work():
     readsFile = r'../input/reads.fq'
     K = 15
     readLength = 75
-    kmerHasher = KmerHash(K, readLength, genomeFile, exonBoundaryFile, readsFile)
+    batchSize = 10000
+    workers = 1
+    canonical = False
+    referenceFirst = False
+    cacheDir = r'../output/kmerCache'
+    packedGenome = False
+    junctionModel = 'all'
+    maxSkip = 2
+    maxMemory = 0
+    spillDir = None
+    prefilter = 0
+    metricsFile = None
+    engine = 'slsqp'
+    schedule = False
+    metrics = HashMetrics(metricsFile)
+    kmerHasher = KmerHash(K, readLength, genomeFile, exonBoundaryFile, readsFile,
+                          batchSize = batchSize, workers = workers, canonical = canonical, referenceFirst = referenceFirst,
+                          cacheDir = cacheDir, packedGenome = packedGenome, junctionModel = junctionModel, maxSkip = maxSkip,
+                          maxMemory = maxMemory, spillDir = spillDir, prefilter = prefilter, metrics = metrics)
     
     print(time.clock() - timeSt)
     
     print('Hashing Finished!')
-    print('Total kmers: ' + str(len(kmerHasher.kmerTable)))
+    print('Total kmers: ' + str(kmerHasher.NW))
     #===========================================================================
     # for x in kmerHasher.temp:
     #     print(x)
@@ -35,9 +54,9 @@ def work():
     #         print('0\t')
     #===========================================================================
     
-    solver = EMAlgorithm(kmerHasher)
+    solver = EMAlgorithm(kmerHasher, workers)
     print('Start iteration')
-    solver.work(10)
+    solver.work(10, engine, schedule)
 
     print('\n======Model Solution==================')
     #print('Model\'s X')
@@ -72,4 +91,5 @@ def work():
     print(np.sqrt(mse / nmse)) 
     print('Time: ' + str(time.clock() - timeSt) + 's')
 
-work()
\ No newline at end of file
+if __name__ == '__main__':
+    work()
\ No newline at end of file